@@ -0,0 +1,74 @@
+import time
+
+import bot_db_async
+import cache_events
+from settings import AUTH_CACHE_TTL
+
+
+class AuthCache:
+    """telegram_id -> (role, username) for AUTH_CACHE_TTL seconds.
+
+    Role changes made through change_user_role() are visible at once in
+    this process and, through cache_events, in every other bot process.
+    """
+
+    def __init__(self, ttl=AUTH_CACHE_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+
+    def get(self, telegram_id):
+        entry = self._entries.get(telegram_id)
+        if entry is None or entry[2] < time.monotonic():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0], entry[1]
+
+    def put(self, telegram_id, role, username):
+        self._entries[telegram_id] = (role, username, time.monotonic() + self.ttl)
+
+    def invalidate(self, telegram_id=None):
+        if telegram_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(telegram_id, None)
+
+    def stats(self):
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+auth_cache = AuthCache()
+cache_events.subscribe("auth", auth_cache.invalidate)
+
+
+async def _load(telegram_id):
+    cached = auth_cache.get(telegram_id)
+    if cached is None:
+        row = await bot_db_async.get_user(telegram_id)
+        if row is not None:
+            auth_cache.put(telegram_id, *row)
+            cached = row
+    return cached
+
+
+async def register_user(telegram_id, username):
+    cached = await _load(telegram_id)
+    if cached is not None and cached[1] == username:
+        return cached[0]
+    role = await bot_db_async.register_user(telegram_id, username)
+    auth_cache.put(telegram_id, role, username)
+    return role
+
+
+async def get_user_role(telegram_id):
+    cached = await _load(telegram_id)
+    return cached[0] if cached else None
+
+
+async def change_user_role(telegram_id, new_role):
+    try:
+        return await bot_db_async.change_user_role(telegram_id, new_role)
+    finally:
+        await cache_events.publish("auth", telegram_id)
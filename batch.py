@@ -0,0 +1,230 @@
+import asyncio
+import itertools
+import re
+import tempfile
+import time
+import zipfile
+
+from aiogram.utils.exceptions import TelegramAPIError
+
+import ref_cache
+from exclusions import get_exclude_raw
+from outbound import bulk
+from reports import get_report, make_report_kwargs
+from report_scheduler import PRIORITY_BATCH
+from settings import BATCH_ZIP_MAX_BYTES, REPORT_MAX_CONCURRENCY
+
+
+BATCH_HELP = (
+    "Формат (каждый параметр с новой строки):\n"
+    "<code>/batch\n"
+    "годы: 2024, 2025\n"
+    "партнёры: все\n"
+    "тнвэд: 8411; 8517\n"
+    "вид: страна</code>\n\n"
+    "<b>партнёры</b> – <code>все</code> или названия через <code>;</code>\n"
+    "<b>тнвэд</b> – необязательно, коды через <code>;</code> (вид «По товару», партнёр весь мир)\n"
+    "<b>подкатегории</b> – необязательно, <code>категория / подкатегория</code> через <code>;</code>\n"
+    "<b>вид</b> – <code>страна</code> (по умолчанию) или <code>самолётик</code>"
+)
+
+KEYS = {
+    "годы": "years", "год": "years",
+    "партнёры": "partners", "партнеры": "partners", "партнёр": "partners", "партнер": "partners",
+    "тнвэд": "tnved", "тн вэд": "tnved",
+    "подкатегории": "subcategories", "подкатегория": "subcategories",
+    "вид": "kind",
+}
+
+
+class BatchSpecError(ValueError):
+    pass
+
+
+def _split(value, sep=";"):
+    return [v.strip() for v in value.split(sep) if v.strip()]
+
+
+async def parse_batch_spec(text, years):
+    """Parse the /batch message into a list of (partner, year, tn_ved, subcategory, plain)."""
+    spec = {}
+    for line in text.splitlines()[1:]:
+        if ":" not in line:
+            continue
+        key, value = line.split(":", 1)
+        key = KEYS.get(key.strip().lower())
+        if key is None:
+            raise BatchSpecError(f"Неизвестный параметр: {line.strip()}")
+        spec[key] = value.strip()
+
+    if "years" not in spec:
+        raise BatchSpecError("Укажите годы.")
+    batch_years = [y for y in re.split(r"[;,\s]+", spec["years"]) if y]
+    bad = [y for y in batch_years if y not in years]
+    if bad:
+        raise BatchSpecError(f"Таких годов нет: {', '.join(bad)}")
+
+    plain = 1 if spec.get("kind", "").lower() in ("самолётик", "самолетик") else 0
+
+    tn_veds = _split(spec.get("tnved", ""))
+    if tn_veds:
+        bad = [c for c in tn_veds if not await ref_cache.tnved_exists(c)]
+        if bad:
+            raise BatchSpecError(f"Таких кодов ТН ВЭД нет: {', '.join(bad)}")
+        return [("весь мир", int(y), code, None, 0) for code, y in itertools.product(tn_veds, batch_years)]
+
+    partners_value = spec.get("partners", "")
+    if partners_value.lower() in ("все", "*"):
+        partners = list(await ref_cache.get_partners())
+    else:
+        partners = _split(partners_value)
+        if not partners:
+            raise BatchSpecError("Укажите партнёров.")
+        bad = [p for p in partners if not await ref_cache.is_partner(p)]
+        if bad:
+            raise BatchSpecError(f"Таких партнёров нет: {'; '.join(bad)}")
+
+    subcategories = [None]
+    if spec.get("subcategories") and not plain:
+        subcategories = []
+        for item in _split(spec["subcategories"]):
+            parent, _, sub = (p.strip() for p in item.partition("/"))
+            if not await ref_cache.is_subcategory(parent, sub):
+                raise BatchSpecError(f"Такой подкатегории нет: {item}")
+            subcategories.append(sub)
+
+    return [
+        (partner, int(y), None, sub, plain)
+        for partner, y, sub in itertools.product(partners, batch_years, subcategories)
+    ]
+
+
+class _ZipSink:
+    """Writes results into a zip on disk as they arrive and sends each zip
+    once the next file would push it past ``max_bytes``, so neither the
+    documents nor the archives pile up in memory."""
+
+    def __init__(self, target, max_bytes):
+        self.target = target
+        self.max_bytes = max_bytes
+        self.count = 0
+        self._names = {}
+        self._out = None
+        self._zip = None
+        self._size = 0
+        self._sent = 0
+        self._lock = asyncio.Lock()
+
+    def _unique(self, name):
+        # identical short filenames (e.g. same partner, different years) must not collide
+        n = self._names.get(name, 0)
+        self._names[name] = n + 1
+        if not n:
+            return name
+        stem, dot, ext = name.rpartition(".")
+        return f"{stem} ({n}).{ext}" if dot else f"{name} ({n})"
+
+    def _write(self, name, content):
+        """Blocking; returns a finished archive to send, if any."""
+        finished = None
+        if self._zip is not None and self._size and self._size + len(content) > self.max_bytes:
+            finished = self._close()
+        if self._zip is None:
+            self._out = tempfile.TemporaryFile()
+            self._zip = zipfile.ZipFile(self._out, "w", zipfile.ZIP_DEFLATED)
+            self._size = 0
+        self._zip.writestr(name, content)
+        self._size += len(content)
+        return finished
+
+    def _close(self):
+        self._zip.close()
+        out, self._zip, self._out = self._out, None, None
+        out.seek(0)
+        return out
+
+    async def _send(self, archive, last):
+        self._sent += 1
+        name = "batch.zip" if last and self._sent == 1 else f"batch_{self._sent}.zip"
+        try:
+            await self.target.answer_document((name, archive))
+        finally:
+            archive.close()
+
+    async def add(self, name, content):
+        async with self._lock:
+            finished = await asyncio.to_thread(self._write, self._unique(name), content)
+            self.count += 1
+            if finished is not None:
+                await self._send(finished, last=False)
+
+    async def close(self):
+        async with self._lock:
+            if self._zip is not None:
+                await self._send(await asyncio.to_thread(self._close), last=True)
+
+    def discard(self):
+        if self._zip is not None:
+            self._close().close()
+
+
+async def run_batch(target, telegram_id, combos):
+    with bulk():
+        await _run_batch(target, telegram_id, combos)
+
+
+async def _run_batch(target, telegram_id, combos):
+    started = time.monotonic()
+    exclude_raw = await get_exclude_raw()
+    status = await target.answer(f"Пакетная генерация: 0 из {len(combos)}.")
+    slots = asyncio.Semaphore(REPORT_MAX_CONCURRENCY)
+    sink = _ZipSink(target, BATCH_ZIP_MAX_BYTES)
+    no_data, errors = 0, []
+    done = 0
+    last_edit = 0.0
+
+    async def one(combo):
+        nonlocal done, no_data, last_edit
+        report_kwargs, hist_txt = make_report_kwargs(*combo, exclude_raw=exclude_raw)
+        async with slots:
+            try:
+                res = await get_report(
+                    use_file_id=False,
+                    requester={
+                        "telegram_id": ("batch", telegram_id),
+                        "priority": PRIORITY_BATCH,
+                        "user_limit": REPORT_MAX_CONCURRENCY,
+                    },
+                    **report_kwargs,
+                )
+            except Exception as e:
+                errors.append(f"{hist_txt} {combo[1]}: {e}")
+                res = None
+        if res is not None:
+            if res["status"] == 'no_data':
+                no_data += 1
+            else:
+                await sink.add(res["short_filename"], res["content"])
+        done += 1
+        if time.monotonic() - last_edit > 5 or done == len(combos):
+            last_edit = time.monotonic()
+            try:
+                await status.edit_text(f"Пакетная генерация: {done} из {len(combos)}.")
+            except TelegramAPIError:
+                pass
+
+    try:
+        await asyncio.gather(*(one(c) for c in combos))
+        await sink.close()
+    finally:
+        sink.discard()
+    elapsed = time.monotonic() - started
+
+    summary = [
+        f"Пакетная генерация завершена за {elapsed:.0f} с.",
+        f"Справок: {sink.count}, без данных: {no_data}, ошибок: {len(errors)}.",
+        f"Скорость: {len(combos) / elapsed * 60:.1f} справок/мин." if elapsed else "",
+    ]
+    if errors:
+        summary.append("Ошибки:\n" + "\n".join(errors[:20]))
+    await target.answer("\n".join(s for s in summary if s))
@@ -0,0 +1,101 @@
+"""Updates/sec for blocking vs executor-backed DB access.
+
+Each simulated update performs the DB round-trips of one step of the
+/start flow. Runs against the databases from config.py and writes to
+them (the users tables and their migrations, bench_* users), so it only
+starts with --write-db; point config.py at a throwaway local Postgres:
+
+    python -m bench.bench_db --write-db --users 50 --updates 20
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import bot_db
+import bot_db_async
+
+
+TELEGRAM_ID_BASE = 900_000_000
+
+
+def _blocking_update(user_no, step):
+    telegram_id = TELEGRAM_ID_BASE + user_no
+    if step % 3 == 0:
+        bot_db.register_user(telegram_id, f"bench_{user_no}")
+        bot_db.get_user_role(telegram_id)
+    elif step % 3 == 1:
+        bot_db.get_partners()
+    else:
+        for c in bot_db.get_categories()[:1]:
+            bot_db.get_subcategories(c)
+
+
+async def _async_update(user_no, step):
+    telegram_id = TELEGRAM_ID_BASE + user_no
+    if step % 3 == 0:
+        await bot_db_async.register_user(telegram_id, f"bench_{user_no}")
+        await bot_db_async.get_user_role(telegram_id)
+    elif step % 3 == 1:
+        await bot_db_async.get_partners()
+    else:
+        for c in (await bot_db_async.get_categories())[:1]:
+            await bot_db_async.get_subcategories(c)
+
+
+async def _user(mode, user_no, updates):
+    for step in range(updates):
+        if mode == "blocking":
+            _blocking_update(user_no, step)
+        else:
+            await _async_update(user_no, step)
+        await asyncio.sleep(0)
+
+
+async def _loop_lag(stop, lags, interval=0.01):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started - interval)
+
+
+async def run(mode, users, updates):
+    stop = asyncio.Event()
+    lags = []
+    lag_task = asyncio.create_task(_loop_lag(stop, lags))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(_user(mode, n, updates) for n in range(users)))
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    await lag_task
+    lags.sort()
+    p99 = lags[int(len(lags) * 0.99) - 1] if lags else 0.0
+    print(
+        f"{mode:>8}: {users * updates / elapsed:8.1f} updates/s, "
+        f"loop lag median={statistics.median(lags or [0]) * 1000:.1f} ms, "
+        f"p99={p99 * 1000:.1f} ms, max={max(lags or [0]) * 1000:.1f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--updates", type=int, default=20)
+    parser.add_argument("--mode", choices=["blocking", "async", "both"], default="both")
+    parser.add_argument("--write-db", action="store_true",
+                        help="confirm that the databases in config.py are a throwaway bench copy")
+    args = parser.parse_args()
+    if not args.write_db:
+        parser.error("the run writes to the databases from config.py; pass --write-db if they are a bench copy")
+
+    bot_db.setup_users_tables()
+    for mode in (["blocking", "async"] if args.mode == "both" else [args.mode]):
+        asyncio.run(run(mode, args.users, args.updates))
+    print(bot_db.get_pool_stats())
+    bot_db_async.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,405 @@
+"""Per-step latency of the /start flow for N concurrent virtual users.
+
+Drives the dispatcher from bot.py with synthetic updates, walking
+/start -> variant -> partner -> year -> category -> confirmation, while
+Telegram is replaced by a local stub server and the report generator by
+bench/fake_generator. Runs against the databases from config.py and
+writes to them (bench users, download history, report file ids), so it
+only starts with --write-db; point config.py at a throwaway local
+Postgres. --seed creates and fills the trade tables the bot reads, and
+--bump-data-version touches the trade ``data`` table so the report caches
+of earlier runs no longer apply. With TRADE_AGGREGATES on, the run first
+sets up data_year_summary and checks that its triggers kept it equal to a
+recount of data. Updates dropped by the per-user rate
+limits are counted per step, apart from the latencies; --no-throttle
+lifts the limits:
+
+    python -m bench.bench_flow --write-db --seed --users 50 --rounds 3
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import tempfile
+import time
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+
+from aiohttp import web
+
+import bot_db
+from settings import TRADE_AGGREGATES
+
+
+FAKE_GENERATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_generator")
+TELEGRAM_ID_BASE = 910_000_000
+
+FIXTURE_SQL = """
+CREATE TABLE IF NOT EXISTS regions (id SERIAL PRIMARY KEY, name TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS data (id SERIAL PRIMARY KEY, region_id INT, year INT, value NUMERIC);
+CREATE TABLE IF NOT EXISTS country_groups (id SERIAL PRIMARY KEY, name TEXT NOT NULL, parent_id INT);
+CREATE TABLE IF NOT EXISTS countries (id SERIAL PRIMARY KEY, name_ru TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS tn_veds (code TEXT NOT NULL, digit INT NOT NULL);
+CREATE TABLE IF NOT EXISTS tn_ved_categories (id SERIAL PRIMARY KEY, name TEXT NOT NULL, parent_id INT);
+"""
+
+
+def seed_trade_db(countries=200, categories=10, subcategories=8):
+    """Fill the fixture tables, unless they already hold data."""
+    with bot_db.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(FIXTURE_SQL)
+        cursor.execute("SELECT count(*) FROM countries;")
+        if cursor.fetchone()[0]:
+            conn.commit()
+            return
+        cursor.execute("INSERT INTO regions (name) VALUES ('Республика Казахстан') RETURNING id;")
+        region_id = cursor.fetchone()[0]
+        cursor.executemany(
+            "INSERT INTO data (region_id, year, value) VALUES (%s, %s, %s);",
+            [(region_id, year, n) for year in range(2019, 2027) for n in range(10)],
+        )
+        cursor.execute("INSERT INTO country_groups (name) VALUES ('весь мир') RETURNING id;")
+        world = cursor.fetchone()[0]
+        cursor.executemany(
+            "INSERT INTO country_groups (name, parent_id) VALUES (%s, %s);",
+            [(f"Группа {n}", world) for n in range(5)],
+        )
+        cursor.executemany("INSERT INTO countries (name_ru) VALUES (%s);", [(f"Страна {n:03d}",) for n in range(countries)])
+        cursor.executemany(
+            "INSERT INTO tn_veds (code, digit) VALUES (%s, %s);",
+            [(f"{n:04d}", 4) for n in range(100, 9700, 7)],
+        )
+        for c in range(categories):
+            cursor.execute("INSERT INTO tn_ved_categories (name) VALUES (%s) RETURNING id;", (f"Категория {c}",))
+            parent = cursor.fetchone()[0]
+            cursor.executemany(
+                "INSERT INTO tn_ved_categories (name, parent_id) VALUES (%s, %s);",
+                [(f"Подкатегория {c}.{s}", parent) for s in range(subcategories)],
+            )
+        conn.commit()
+        cursor.close()
+
+
+def bump_data_version():
+    """New data version, so the report caches of earlier runs do not apply.
+
+    Goes through INSERT, UPDATE and DELETE, so with TRADE_AGGREGATES on all
+    three data_year_summary triggers fire.
+    """
+    with bot_db.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO data (region_id, year, value) VALUES (NULL, 0, 0) RETURNING id;")
+        row_id = cursor.fetchone()[0]
+        cursor.execute("UPDATE data SET year = 1 WHERE id = %s;", (row_id,))
+        cursor.execute("DELETE FROM data WHERE id = %s;", (row_id,))
+        conn.commit()
+        cursor.close()
+
+
+def check_trade_aggregates():
+    """(region_id, year, summary rows, counted rows) where data_year_summary
+    disagrees with a recount of data."""
+    with bot_db.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT region_id, year, s.rows, d.rows
+            FROM data_year_summary s
+            FULL JOIN (
+                SELECT COALESCE(region_id, -1) AS region_id, year, count(*) AS rows
+                FROM data
+                WHERE year IS NOT NULL
+                GROUP BY 1, 2
+            ) d USING (region_id, year)
+            WHERE s.rows IS DISTINCT FROM d.rows;
+        """)
+        mismatches = cursor.fetchall()
+        conn.rollback()
+        cursor.close()
+    return mismatches
+
+
+class TelegramStub:
+    """Answers every Bot API method like Telegram would, after ``delay`` seconds."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.calls = defaultdict(int)
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+
+    def _message(self, chat_id, **extra):
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id or 0), "type": "private"},
+            **extra,
+        }
+
+    async def handle(self, request):
+        method = request.match_info["method"].lower()
+        form = await request.post()
+        self.calls[method] += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+
+        chat_id = form.get("chat_id")
+        if method in ("answercallbackquery", "deletemessage", "setwebhook"):
+            result = True
+        elif method == "senddocument":
+            n = next(self._file_ids)
+            result = self._message(chat_id, document={"file_id": f"bench-file-{n}", "file_unique_id": f"u{n}"})
+        else:
+            result = self._message(chat_id, text=form.get("text", ""))
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self):
+        app = web.Application(client_max_size=64 * 1024 ** 2)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", 0).start()
+        host, port = self._runner.addresses[0][:2]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+class VirtualUser:
+    """Builds the updates of one user's walk through the flow."""
+
+    _update_ids = itertools.count(1)
+
+    def __init__(self, n):
+        self.telegram_id = TELEGRAM_ID_BASE + n
+        self.user = {"id": self.telegram_id, "is_bot": False, "first_name": f"bench{n}", "username": f"bench_{n}"}
+        self.chat = {"id": self.telegram_id, "type": "private"}
+        self._message_ids = itertools.count(1)
+
+    def message(self, text):
+        return {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": self.chat,
+                "from": self.user,
+                "text": text,
+                **({"entities": [{"type": "bot_command", "offset": 0, "length": len(text)}]} if text.startswith("/") else {}),
+            },
+        }
+
+    def callback(self, data):
+        n = next(self._update_ids)
+        return {
+            "update_id": n,
+            "callback_query": {
+                "id": str(n),
+                "from": self.user,
+                "chat_instance": str(self.telegram_id),
+                "data": data,
+                "message": {
+                    "message_id": next(self._message_ids),
+                    "date": int(time.time()),
+                    "chat": self.chat,
+                    "text": "bench",
+                },
+            },
+        }
+
+
+# set by run_user around each update, so the middleware can flag it
+_throttled = ContextVar("bench_throttled", default=None)
+
+
+def install_throttling(dp, limits=None):
+    """Swap bot.py's ThrottlingMiddleware for one that flags the updates it
+    drops, optionally with other (rate, burst) limits for every class."""
+    from aiogram.dispatcher.handler import CancelHandler
+    from throttling import GENERATION, NAVIGATION, RateLimiter, ThrottlingMiddleware
+
+    class BenchThrottling(ThrottlingMiddleware):
+        async def on_pre_process_message(self, message, data):
+            try:
+                await super().on_pre_process_message(message, data)
+            except CancelHandler:
+                _throttled.get()[0] = True
+                raise
+
+        async def on_pre_process_callback_query(self, cbq, data):
+            try:
+                await super().on_pre_process_callback_query(cbq, data)
+            except CancelHandler:
+                _throttled.get()[0] = True
+                raise
+
+    limiter = RateLimiter({NAVIGATION: limits, GENERATION: limits}) if limits else None
+    apps = dp.middleware.applications
+    i = next(i for i, m in enumerate(apps) if isinstance(m, ThrottlingMiddleware))
+    apps[i] = BenchThrottling(limiter=limiter)
+    apps[i].setup(dp.middleware)
+
+
+async def plan_flow(user, rng):
+    """[(step name, update)] for one report, chosen at random from the fixtures."""
+    import partner_picker
+    import ref_cache
+
+    index = await partner_picker.get_partner_index()
+    partner_no = rng.randrange(len(index.partners))
+    year = rng.choice(await ref_cache.get_years())
+    variant = "plane_cb" if rng.random() < 0.3 else "country_cb"
+    steps = [
+        ("start", user.message("/start")),
+        ("variant", user.callback(variant)),
+        ("partner", user.callback(f"pp:P:{index.version}:{partner_no}")),
+        ("year", user.message(year)),
+    ]
+    if variant == "country_cb":
+        categories = await ref_cache.get_categories()
+        if rng.random() < 0.5 or not categories:
+            steps.append(("category", user.message("Без категории")))
+        else:
+            category = rng.choice(categories)
+            steps.append(("category", user.message(category)))
+            subcategories = await ref_cache.get_subcategories(category)
+            steps.append(("subcategory", user.message(rng.choice(subcategories))))
+    steps.append(("confirmation", user.callback("sn_confirm")))
+    return steps
+
+
+async def run_user(dp, n, rounds, think, timings, throttled, errors, seed):
+    from aiogram import types
+
+    rng = random.Random(seed + n)
+    user = VirtualUser(n)
+    for _ in range(rounds):
+        for step, update in await plan_flow(user, rng):
+            flag = [False]
+            _throttled.set(flag)
+            started = time.perf_counter()
+            try:
+                await dp.process_update(types.Update(**update))
+            except Exception as e:
+                errors[f"{step}: {type(e).__name__}: {e}"] += 1
+            if flag[0]:
+                # dropped before any handler ran: not a latency sample
+                throttled[step] += 1
+            else:
+                timings[step].append(time.perf_counter() - started)
+            if think:
+                await asyncio.sleep(rng.uniform(0, 2 * think))
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))]
+
+
+def print_report(timings, throttled, errors, elapsed, users, rounds, stub):
+    print(f"\n{users} users x {rounds} flows in {elapsed:.1f} s: "
+          f"{users * rounds / elapsed:.2f} flows/s, "
+          f"{sum(map(len, timings.values())) / elapsed:.1f} updates/s handled, "
+          f"{sum(throttled.values())} throttled\n")
+    print(f"{'step':<14}{'n':>7}{'thr':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    order = ["start", "variant", "partner", "year", "category", "subcategory", "confirmation"]
+    for step in sorted(set(timings) | set(throttled), key=order.index):
+        values = sorted(timings[step])
+        print(f"{step:<14}{len(values):>7}{throttled[step]:>7}" + "".join(
+            f"{percentile(values, p) * 1000:>10.1f}" for p in (50, 95, 99, 100)
+        ))
+    print("\nTelegram API calls: " + ", ".join(f"{k}={v}" for k, v in sorted(stub.calls.items())))
+    if errors:
+        print("\nErrors:")
+        for error, count in errors.most_common(10):
+            print(f"  {count} x {error}")
+
+
+async def run(args):
+    from aiogram import Bot, Dispatcher
+    from aiogram.bot.api import TelegramAPIServer
+
+    stub = TelegramStub(args.api_delay)
+    base = await stub.start()
+
+    import report_pool
+    report_pool.REPORT_MODULE_PATH = FAKE_GENERATOR
+    import report_cache
+    report_cache.report_cache.directory = args.cache_dir
+    import bot as bot_app
+    import bot_db_async
+
+    dp = bot_app.dp
+    dp.bot.server = TelegramAPIServer.from_base(base)
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+    install_throttling(dp, (1e9, 1e9) if args.no_throttle else None)
+
+    bot_app.setup_databases()
+    for n in range(args.users):
+        telegram_id = TELEGRAM_ID_BASE + n
+        await bot_db_async.register_user(telegram_id, f"bench_{n}")
+        await bot_db_async.change_user_role(telegram_id, "advanced")
+
+    await bot_app.on_startup(dp)
+    timings = defaultdict(list)
+    throttled = Counter()
+    errors = Counter()
+    try:
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            run_user(dp, n, args.rounds, args.think, timings, throttled, errors, args.random_seed)
+            for n in range(args.users)
+        ))
+        elapsed = time.perf_counter() - started
+    finally:
+        await bot_app.on_shutdown(dp)
+        await dp.bot.session.close()
+        await stub.stop()
+    print_report(timings, throttled, errors, elapsed, args.users, args.rounds, stub)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--rounds", type=int, default=3, help="reports per user")
+    parser.add_argument("--think", type=float, default=0.0, help="mean pause between a user's steps, seconds")
+    parser.add_argument("--api-delay", type=float, default=0.05, help="stub Telegram API latency, seconds")
+    parser.add_argument("--render-seconds", type=float, default=1.0, help="fake generator run time")
+    parser.add_argument("--write-db", action="store_true",
+                        help="confirm that the databases in config.py are a throwaway bench copy")
+    parser.add_argument("--seed", action="store_true", help="create and fill the fixture trade tables first")
+    parser.add_argument("--bump-data-version", action="store_true",
+                        help="insert and delete a row in the trade data table, so report caches of earlier runs do not apply")
+    parser.add_argument("--warm", action="store_true", help="keep the report file cache from earlier runs")
+    parser.add_argument("--no-throttle", action="store_true",
+                        help="lift the per-user rate limits, to measure the flow rather than the limiter")
+    parser.add_argument("--random-seed", type=int, default=1)
+    args = parser.parse_args()
+    if not args.write_db:
+        parser.error("the run writes to the databases from config.py; pass --write-db if they are a bench copy")
+
+    os.environ["BENCH_RENDER_SECONDS"] = str(args.render_seconds)
+    if args.seed:
+        seed_trade_db()
+    if TRADE_AGGREGATES:
+        # before the bump, so its writes go through the triggers
+        bot_db.apply_trade_migrations()
+    if args.bump_data_version:
+        bump_data_version()
+        time.sleep(1)   # pg_stat_user_tables is updated asynchronously
+    if TRADE_AGGREGATES:
+        mismatches = check_trade_aggregates()
+        if mismatches:
+            raise SystemExit(f"data_year_summary is out of step with data: {mismatches[:10]}")
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        args.cache_dir = os.path.join(cache_dir, "report_cache") if not args.warm else "report_cache"
+        asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+"""Stand-in for the real document_gen package, used by bench/bench_flow.py.
+
+Sleeps for BENCH_RENDER_SECONDS (the real generator's DB queries and
+layout work) and returns a small .docx with BENCH_DOC_PARAGRAPHS lines.
+"""
+import os
+import time
+
+from docx import Document
+
+
+def generate_trade_document(country_or_group, end_year, tn_ved=None, category=None, plain=0, **_kwargs):
+    time.sleep(float(os.environ.get("BENCH_RENDER_SECONDS", "1.0")))
+
+    doc = Document()
+    title = f"{country_or_group} {end_year} {tn_ved or category or ''}".strip()
+    doc.add_heading(title, level=1)
+    for n in range(int(os.environ.get("BENCH_DOC_PARAGRAPHS", "200"))):
+        doc.add_paragraph(f"Строка {n}: {title}")
+
+    short_filename = f"{country_or_group}_{end_year}{'_plain' if plain else ''}.docx"
+    return {
+        "status": "ok",
+        "doc": doc,
+        "filename": f"Справка {title}.docx",
+        "short_filename": short_filename,
+    }
@@ -1,30 +1,106 @@
-from aiogram import Bot, Dispatcher, executor, types
+import asyncio
+import logging
+import time
+from aiogram import Dispatcher, executor, types
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
 import pandas as pd 
 from config import API_TOKEN
 from handlers import (
     access_settings_handler,
     handle_access_data,
     download_history_handler,
+    recent_history_handler,
+    recent_history_page_cb,
+    pool_stats_handler,
+    refresh_cache_handler,
+    exclusions_handler,
+    rebuild_aggregates_handler,
+    batch_handler,
     start_new_handler,
     start_new_variant_chosen,
     start_new_waiting_tnved,
     start_new_partner,
+    start_new_partner_cb,
     start_new_year,
     start_new_category,
     start_new_subcategory,
     start_new_confirmation,)
 from aiogram.types import Message
 from states import StartNewStates
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from fsm_storage import make_storage
+from settings import FSM_STORAGE, BOT_MODE, TRADE_AGGREGATES, HISTORY_PARTITIONING
 from aiogram.dispatcher import FSMContext
-from bot_db import setup_users_tables
+from bot_db import setup_users_tables, apply_trade_migrations, trade_pool, users_pool, close_pools, get_pool_stats
+from report_pool import report_pool
+import bot_db_async
+import ref_cache
+import keyboards
+import partner_picker
+import exclusions
+import report_jobs
+import cache_events
+from history_writer import history_writer, maintain_history_partitions
+from throttling import ThrottlingMiddleware
+from outbound import ThrottledBot, send_scheduler
+from auth_cache import auth_cache
+from reports import get_report_stats
+import metrics
 
 
-setup_users_tables()
+logging.basicConfig(level=logging.INFO)
 
 
-bot = Bot(token=API_TOKEN)
-dp = Dispatcher(bot, storage=MemoryStorage())
+bot = ThrottledBot(token=API_TOKEN)
+dp = Dispatcher(bot, storage=make_storage(FSM_STORAGE))
+
+
+class TimingMiddleware(BaseMiddleware):
+    """Feeds bot_handler_seconds with the run time of every handler."""
+
+    async def _start(self, data):
+        handler = current_handler.get()
+        data["_timing"] = (handler.__name__ if handler else "unknown", time.perf_counter())
+
+    async def _stop(self, data):
+        timing = data.pop("_timing", None)
+        if timing is not None:
+            metrics.handler_seconds.observe(time.perf_counter() - timing[1], handler=timing[0])
+
+    async def on_process_message(self, message, data):
+        await self._start(data)
+
+    async def on_post_process_message(self, message, results, data):
+        await self._stop(data)
+
+    async def on_process_callback_query(self, cbq, data):
+        await self._start(data)
+
+    async def on_post_process_callback_query(self, cbq, results, data):
+        await self._stop(data)
+
+
+dp.middleware.setup(ThrottlingMiddleware())
+dp.middleware.setup(TimingMiddleware())
+
+
+@metrics.add_collector
+def collect_gauges():
+    gauges = {}
+    for pool, st in get_pool_stats().items():
+        for k, v in st.items():
+            gauges[(f"bot_db_pool_{k}", (("pool", pool),))] = v
+    for k, v in get_report_stats().items():
+        gauges[(f"bot_reports_{k}", ())] = v
+    for k, v in ref_cache.ref_cache.stats().items():
+        gauges[(f"bot_ref_cache_{k}", ())] = v
+    for k, v in auth_cache.stats().items():
+        gauges[(f"bot_auth_cache_{k}", ())] = v
+    for k, v in history_writer.stats().items():
+        gauges[(f"bot_history_{k}", ())] = v
+    for k, v in send_scheduler.stats().items():
+        gauges[(f"bot_send_{k}", ())] = v
+    return gauges
 
 
 
@@ -40,6 +116,34 @@ async def process_access_settings(message: types.Message, state: FSMContext):
 async def cmd_history(message: types.Message):
     await download_history_handler(message)
 
+@dp.message_handler(commands=['history_recent'])
+async def cmd_history_recent(message: types.Message):
+    await recent_history_handler(message)
+
+@dp.callback_query_handler(lambda c: c.data and c.data.startswith('hist:'), state='*')
+async def cbq_history_recent_page(cbq: types.CallbackQuery):
+    await recent_history_page_cb(cbq)
+
+@dp.message_handler(commands=['pool_stats'])
+async def cmd_pool_stats(message: types.Message):
+    await pool_stats_handler(message)
+
+@dp.message_handler(commands=['refresh_cache'])
+async def cmd_refresh_cache(message: types.Message):
+    await refresh_cache_handler(message)
+
+@dp.message_handler(commands=['rebuild_aggregates'])
+async def cmd_rebuild_aggregates(message: types.Message):
+    await rebuild_aggregates_handler(message)
+
+@dp.message_handler(commands=['exclusions'])
+async def cmd_exclusions(message: types.Message):
+    await exclusions_handler(message)
+
+@dp.message_handler(commands=['batch'])
+async def cmd_batch(message: types.Message):
+    await batch_handler(message)
+
 @dp.message_handler(commands=['start'], state='*')
 async def cmd_start_new(message: Message, state: FSMContext):
     await start_new_handler(message, state)
@@ -56,6 +160,10 @@ async def msg_start_new_tnved(message: Message, state: FSMContext):
 async def msg_start_new_partner(message: Message, state: FSMContext):
     await start_new_partner(message, state)
 
+@dp.callback_query_handler(lambda c: c.data and c.data.startswith('pp:'), state=StartNewStates.choosing_partner)
+async def cbq_start_new_partner(cbq: types.CallbackQuery, state: FSMContext):
+    await start_new_partner_cb(cbq, state)
+
 @dp.message_handler(state=StartNewStates.choosing_year)
 async def msg_start_new_year(message: Message, state: FSMContext):
     await start_new_year(message, state)
@@ -72,5 +180,44 @@ async def msg_start_new_subcategory(message: Message, state: FSMContext):
 async def cbq_start_new_confirmation(cbq: types.CallbackQuery, state: FSMContext):
     await start_new_confirmation(cbq, state)
 
+def setup_databases():
+    # once per deployment, before any update is processed; webhook workers
+    # import this module and must not repeat it
+    setup_users_tables()
+    if TRADE_AGGREGATES:
+        apply_trade_migrations()
+
+async def on_startup(dp):
+    dp['cache_events'] = asyncio.ensure_future(cache_events.listen())
+    trade_pool.warm_up()
+    users_pool.warm_up()
+    report_pool.start()
+    await ref_cache.warm_up()
+    await keyboards.warm_up()
+    await partner_picker.get_partner_index()
+    await exclusions.get_exclusions()
+    dp['report_jobs_consumer'] = asyncio.ensure_future(report_jobs.consume(dp.bot))
+    dp['metrics_server'] = await metrics.start_server()
+    dp['history_partitions'] = asyncio.ensure_future(maintain_history_partitions()) if HISTORY_PARTITIONING else None
+
+async def on_shutdown(dp):
+    dp['report_jobs_consumer'].cancel()
+    dp['cache_events'].cancel()
+    if dp['history_partitions'] is not None:
+        dp['history_partitions'].cancel()
+    if dp['metrics_server'] is not None:
+        await dp['metrics_server'].cleanup()
+    # flush buffered writes while the DB pools are still open
+    await dp.storage.close()
+    await history_writer.close()
+    report_pool.shutdown()
+    bot_db_async.shutdown()
+    close_pools()
+
 if __name__ == '__main__':
-    executor.start_polling(dp, skip_updates=True)
+    setup_databases()
+    if BOT_MODE == 'webhook':
+        import webhook
+        webhook.main()
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
@@ -1,266 +1,953 @@
 import psycopg2
+from datetime import datetime, timedelta
 from config import DB_CONFIG, USERS_DB_CONFIG
 from contextvars import ContextVar
+from psycopg2.extras import Json, execute_values
+from db_pool import ConnectionPool
+from settings import (
+    DB_POOL_MIN_SIZE,
+    DB_POOL_MAX_SIZE,
+    DB_POOL_MAX_USES,
+    DB_POOL_BORROW_TIMEOUT,
+    DB_POOL_HEALTH_CHECK_AFTER,
+    HISTORY_PARTITIONING,
+    HISTORY_PARTITIONS_AHEAD,
+    TRADE_AGGREGATES,
+)
+
+
+MIGRATIONS_LOCK_ID = 7_240_001
+TRADE_MIGRATIONS_LOCK_ID = 7_240_002
+
+
+def _make_pool(dsn_kwargs):
+    return ConnectionPool(
+        dsn_kwargs,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        max_uses=DB_POOL_MAX_USES,
+        borrow_timeout=DB_POOL_BORROW_TIMEOUT,
+        health_check_after=DB_POOL_HEALTH_CHECK_AFTER,
+    )
+
+
+trade_pool = _make_pool(DB_CONFIG)
+users_pool = _make_pool(USERS_DB_CONFIG)
 
 
 def get_connection():
-    return psycopg2.connect(**DB_CONFIG)
+    return trade_pool.connection()
 
-def tnved_exists(code: str):
-    conn = get_connection()
-    cursor = conn.cursor()
+def get_users_connection():
+    return users_pool.connection()
 
-    cursor.execute("""
-        SELECT 1
-        FROM tn_veds
-        WHERE code = %s
-          AND digit IN (4, 6, 10)
-        LIMIT 1;
-    """, (code,))
+def get_pool_stats():
+    return {"trade": trade_pool.stats(), "users": users_pool.stats()}
 
-    exists = cursor.fetchone() is not None
+def close_pools():
+    trade_pool.close()
+    users_pool.close()
 
+def open_listen_connection(channel):
+    """A connection of its own, outside the pool, LISTENing on ``channel``;
+    the caller polls it for notifies and closes it."""
+    conn = psycopg2.connect(**USERS_DB_CONFIG, keepalives=1, keepalives_idle=30)
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    cursor = conn.cursor()
+    cursor.execute(f"LISTEN {channel};")
     cursor.close()
-    conn.close()
+    return conn
+
+def notify(channel, payload):
+    with get_users_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT pg_notify(%s, %s);", (channel, payload))
+        conn.commit()
+        cursor.close()
+
+def tnved_exists(code: str):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute("""
+            SELECT 1
+            FROM tn_veds
+            WHERE code = %s
+              AND digit IN (4, 6, 10)
+            LIMIT 1;
+        """, (code,))
+
+        exists = cursor.fetchone() is not None
+
+        cursor.close()
     return exists
 
 def get_regions():
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT DISTINCT r.name
-        FROM regions r
-        JOIN data d ON r.id = d.region_id
-        ORDER BY r.name;
-    """)
-    regions = [row[0] for row in cursor.fetchall()]
-    cursor.close()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT DISTINCT r.name
+            FROM regions r
+            JOIN data d ON r.id = d.region_id
+            ORDER BY r.name;
+        """)
+        regions = [row[0] for row in cursor.fetchall()]
+        cursor.close()
     return regions
 
 
 def get_partners():
-    conn = get_connection()
-    cursor = conn.cursor()
-
-    partners = ["весь мир"]   
-    
-    cursor.execute("""
-        SELECT name
-        FROM country_groups
-        WHERE parent_id IS NOT NULL
-        AND name <> 'весь мир'
-        ORDER BY name
-    """)
-    partners.extend(row[0] for row in cursor.fetchall())
-
-    cursor.execute("""
-        SELECT DISTINCT name_ru
-        FROM countries
-        ORDER BY name_ru
-    """)
-    partners.extend(row[0] for row in cursor.fetchall())
-
-    cursor.close()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+
+        partners = ["весь мир"]
+
+        cursor.execute("""
+            SELECT name
+            FROM country_groups
+            WHERE parent_id IS NOT NULL
+            AND name <> 'весь мир'
+            ORDER BY name
+        """)
+        partners.extend(row[0] for row in cursor.fetchall())
+
+        cursor.execute("""
+            SELECT DISTINCT name_ru
+            FROM countries
+            ORDER BY name_ru
+        """)
+        partners.extend(row[0] for row in cursor.fetchall())
+
+        cursor.close()
     return partners
 
 
 def get_years():
-    conn = get_connection()
-    cursor = conn.cursor()
-
-    cursor.execute("""
-        SELECT DISTINCT year
-        FROM data
-        WHERE year > (
-            SELECT MIN(year)
-            FROM data)
-        ORDER BY year;
-    """,)
-    years = [str(row[0]) for row in cursor.fetchall()]
-
-    cursor.close()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+
+        # data_year_summary has one row per (region, year), so this is an
+        # index scan over a few hundred rows instead of two scans of data
+        source = "data_year_summary" if TRADE_AGGREGATES else "data"
+        cursor.execute(f"""
+            SELECT DISTINCT year
+            FROM {source}
+            WHERE year > (
+                SELECT MIN(year)
+                FROM {source})
+            ORDER BY year;
+        """,)
+        years = [str(row[0]) for row in cursor.fetchall()]
+
+        cursor.close()
     return years
 
 
 def get_categories():
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT name FROM public.tn_ved_categories where parent_id is null;
-    """)
-    categories = [row[0] for row in cursor.fetchall()]
-    cursor.close()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT name FROM public.tn_ved_categories where parent_id is null;
+        """)
+        categories = [row[0] for row in cursor.fetchall()]
+        cursor.close()
     return categories
 
 
 def get_subcategories(parent_name: str):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT sc.name
-        FROM tn_ved_categories p
-        JOIN tn_ved_categories sc ON sc.parent_id = p.id
-        WHERE p.name = %s
-        ORDER BY sc.name;
-    """, (parent_name,))
-    subcategories = [row[0] for row in cursor.fetchall()]
-    cursor.close()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT sc.name
+            FROM tn_ved_categories p
+            JOIN tn_ved_categories sc ON sc.parent_id = p.id
+            WHERE p.name = %s
+            ORDER BY sc.name;
+        """, (parent_name,))
+        subcategories = [row[0] for row in cursor.fetchall()]
+        cursor.close()
     return subcategories
 
 
-def get_users_connection():
-    return psycopg2.connect(**USERS_DB_CONFIG)
+def get_all_subcategories():
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT p.name, sc.name
+            FROM tn_ved_categories p
+            JOIN tn_ved_categories sc ON sc.parent_id = p.id
+            ORDER BY p.name, sc.name;
+        """)
+        subcategories = {}
+        for parent_name, name in cursor.fetchall():
+            subcategories.setdefault(parent_name, []).append(name)
+        cursor.close()
+    return subcategories
+
+
+def get_tnved_codes():
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT DISTINCT code
+            FROM tn_veds
+            WHERE digit IN (4, 6, 10);
+        """)
+        codes = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+    return codes
+
+
+def get_data_version():
+    # Changes whenever rows of `data` are inserted, updated or deleted,
+    # and on TRUNCATE (new filenode). Cheap: no scan of the table itself.
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT pg_relation_filenode('data'), n_tup_ins, n_tup_upd, n_tup_del
+            FROM pg_stat_user_tables
+            WHERE relname = 'data';
+        """)
+        row = cursor.fetchone()
+        cursor.close()
+    return ":".join(str(v) for v in row) if row else ""
+
+
+# Row counts of `data` per (region, year), maintained by statement-level
+# triggers from the rows each INSERT/UPDATE/DELETE touched, so loading new
+# data costs one small upsert per statement and no rescans. Rows without a
+# region are counted under region_id -1.
+TRADE_AGGREGATES_SQL = """
+    CREATE TABLE IF NOT EXISTS data_year_summary (
+        region_id INT NOT NULL,
+        year INT NOT NULL,
+        rows BIGINT NOT NULL,
+        PRIMARY KEY (region_id, year)
+    );
+    CREATE INDEX IF NOT EXISTS data_year_summary_year_idx ON data_year_summary (year);
+
+    CREATE OR REPLACE FUNCTION data_year_summary_sync() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP IN ('DELETE', 'UPDATE') THEN
+            UPDATE data_year_summary s
+            SET rows = s.rows - d.n
+            FROM (
+                SELECT COALESCE(region_id, -1) AS region_id, year, count(*) AS n
+                FROM old_rows
+                WHERE year IS NOT NULL
+                GROUP BY 1, 2
+            ) d
+            WHERE s.region_id = d.region_id AND s.year = d.year;
+            DELETE FROM data_year_summary WHERE rows <= 0;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO data_year_summary AS s (region_id, year, rows)
+            SELECT COALESCE(region_id, -1), year, count(*)
+            FROM new_rows
+            WHERE year IS NOT NULL
+            GROUP BY 1, 2
+            ON CONFLICT (region_id, year) DO UPDATE SET rows = s.rows + EXCLUDED.rows;
+        END IF;
+        RETURN NULL;
+    END $$;
+
+    CREATE OR REPLACE FUNCTION data_year_summary_truncate() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        DELETE FROM data_year_summary;
+        RETURN NULL;
+    END $$;
+
+    DROP TRIGGER IF EXISTS data_year_summary_ins ON data;
+    DROP TRIGGER IF EXISTS data_year_summary_upd ON data;
+    DROP TRIGGER IF EXISTS data_year_summary_del ON data;
+    DROP TRIGGER IF EXISTS data_year_summary_trunc ON data;
+    CREATE TRIGGER data_year_summary_ins AFTER INSERT ON data
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION data_year_summary_sync();
+    CREATE TRIGGER data_year_summary_upd AFTER UPDATE ON data
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION data_year_summary_sync();
+    CREATE TRIGGER data_year_summary_del AFTER DELETE ON data
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION data_year_summary_sync();
+    CREATE TRIGGER data_year_summary_trunc AFTER TRUNCATE ON data
+        FOR EACH STATEMENT EXECUTE FUNCTION data_year_summary_truncate();
+"""
+
+
+def _rebuild_trade_aggregates(cursor):
+    # the lock keeps loaders out while the counts are recomputed, so no
+    # trigger delta is lost between the scan and the swap
+    cursor.execute("""
+        LOCK TABLE data IN SHARE MODE;
+        DELETE FROM data_year_summary;
+        INSERT INTO data_year_summary (region_id, year, rows)
+        SELECT COALESCE(region_id, -1), year, count(*)
+        FROM data
+        WHERE year IS NOT NULL
+        GROUP BY 1, 2;
+    """)
+
+
+def _trade_aggregates(cursor):
+    cursor.execute(TRADE_AGGREGATES_SQL)
+    _rebuild_trade_aggregates(cursor)
+    return True
+
+
+# migrations of the trade DB, recorded in its own trade_schema_migrations
+# (DB_CONFIG and USERS_DB_CONFIG may name the same database)
+TRADE_MIGRATIONS = [
+    (1, "data_year_summary and triggers", _trade_aggregates),
+]
+
+
+def apply_trade_migrations():
+    """Create data_year_summary and its triggers in the trade DB once. Needs
+    the rights to create tables and triggers there."""
+    with get_connection() as conn:
+        _apply_migrations(conn, "trade_schema_migrations", TRADE_MIGRATIONS, TRADE_MIGRATIONS_LOCK_ID)
+
+
+def rebuild_trade_aggregates():
+    """Recount data_year_summary from scratch, e.g. after the triggers were
+    disabled for a bulk load. Returns the number of (region, year) rows."""
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        _rebuild_trade_aggregates(cursor)
+        cursor.execute("SELECT count(*) FROM data_year_summary;")
+        count = cursor.fetchone()[0]
+        conn.commit()
+        cursor.close()
+    return count
 
 
 def setup_users_tables():
-    conn = get_users_connection()
-    cursor = conn.cursor()
-    
+    with get_users_connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                id SERIAL PRIMARY KEY,
+                telegram_id BIGINT UNIQUE,
+                username TEXT,
+                role TEXT CHECK (role IN ('admin', 'advanced', 'user')) NOT NULL DEFAULT 'user'
+            );
+        """)
+        conn.commit()
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS download_history (
+                id SERIAL PRIMARY KEY,
+                user_id INT,
+                region TEXT,
+                partner TEXT,
+                year TEXT,
+                downloaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+        conn.commit()
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS fsm_states (
+                chat TEXT NOT NULL,
+                "user" TEXT NOT NULL,
+                state TEXT,
+                data JSONB NOT NULL DEFAULT '{}',
+                bucket JSONB NOT NULL DEFAULT '{}',
+                updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (chat, "user")
+            );
+            CREATE INDEX IF NOT EXISTS fsm_states_updated_at_idx ON fsm_states (updated_at);
+        """)
+        conn.commit()
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS report_jobs (
+                id SERIAL PRIMARY KEY,
+                telegram_id BIGINT NOT NULL,
+                chat_id BIGINT NOT NULL,
+                priority INT NOT NULL DEFAULT 1,
+                params JSONB NOT NULL,
+                state TEXT CHECK (state IN ('queued', 'running', 'done', 'delivered', 'failed')) NOT NULL DEFAULT 'queued',
+                worker TEXT,
+                attempts INT NOT NULL DEFAULT 0,
+                result_key TEXT,
+                error TEXT,
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            );
+            CREATE INDEX IF NOT EXISTS report_jobs_active_idx
+                ON report_jobs (priority, id) WHERE state IN ('queued', 'running');
+        """)
+        conn.commit()
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS tnved_exclusions (
+                code TEXT PRIMARY KEY,
+                added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+        conn.commit()
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS report_files (
+                cache_key TEXT PRIMARY KEY,
+                data_version TEXT NOT NULL,
+                status TEXT,
+                filename TEXT,
+                short_filename TEXT,
+                file_id TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+        conn.commit()
+
+        cursor.close()
+
+    apply_migrations()
+    if HISTORY_PARTITIONING:
+        ensure_history_partitions()
+
+
+def _history_indexes(cursor):
     cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id SERIAL PRIMARY KEY,
-            telegram_id BIGINT UNIQUE,
-            username TEXT,
-            role TEXT CHECK (role IN ('admin', 'advanced', 'user')) NOT NULL DEFAULT 'user'
-        );
+        CREATE INDEX IF NOT EXISTS download_history_downloaded_at_idx
+            ON download_history (downloaded_at DESC, id DESC);
+        CREATE INDEX IF NOT EXISTS download_history_user_id_idx
+            ON download_history (user_id);
     """)
-    conn.commit()
+    return True
+
+
+def _month_starts(first, last):
+    month = first.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    while month <= last:
+        yield month
+        month = (month + timedelta(days=32)).replace(day=1)
+
+
+def _create_history_partitions(cursor, first, last):
+    for month in _month_starts(first, last):
+        next_month = (month + timedelta(days=32)).replace(day=1)
+        cursor.execute("SAVEPOINT history_partition;")
+        try:
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS download_history_{month:%Y_%m}
+                    PARTITION OF download_history
+                    FOR VALUES FROM (%s) TO (%s);
+            """, (month, next_month))
+            cursor.execute("RELEASE SAVEPOINT history_partition;")
+        except psycopg2.Error as e:
+            # rows for this month already landed in the default partition
+            cursor.execute("ROLLBACK TO SAVEPOINT history_partition;")
+            print(f"download_history_{month:%Y_%m} not created, its rows stay in download_history_default: {e}")
+
+
+def _history_partitioning(cursor):
+    if not HISTORY_PARTITIONING:
+        return False
 
     cursor.execute("""
-        CREATE TABLE IF NOT EXISTS download_history (
-            id SERIAL PRIMARY KEY,
+        ALTER TABLE download_history RENAME TO download_history_old;
+        ALTER TABLE download_history_old RENAME CONSTRAINT download_history_pkey TO download_history_old_pkey;
+        CREATE TABLE download_history (
+            id INT NOT NULL DEFAULT nextval('download_history_id_seq'),
             user_id INT,
             region TEXT,
             partner TEXT,
             year TEXT,
-            downloaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            downloaded_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, downloaded_at)
+        ) PARTITION BY RANGE (downloaded_at);
+        ALTER SEQUENCE download_history_id_seq OWNED BY download_history.id;
+        CREATE TABLE download_history_default PARTITION OF download_history DEFAULT;
+        SELECT COALESCE(MIN(downloaded_at), CURRENT_TIMESTAMP::timestamp), CURRENT_TIMESTAMP::timestamp
+        FROM download_history_old;
+    """)
+    first, now = cursor.fetchone()
+    _create_history_partitions(cursor, first, now + timedelta(days=31 * HISTORY_PARTITIONS_AHEAD))
+    cursor.execute("""
+        INSERT INTO download_history (id, user_id, region, partner, year, downloaded_at)
+        SELECT id, user_id, region, partner, year, COALESCE(downloaded_at, CURRENT_TIMESTAMP)
+        FROM download_history_old;
+        DROP TABLE download_history_old;
+    """)
+    _history_indexes(cursor)
+    return True
+
+
+# the list the bot shipped with before exclusions were kept in the DB
+DEFAULT_TNVED_EXCLUSIONS = (
+    "8411,841111,841112,841121,841122,841181,841182,841191,841199,851711,851712,851713,851714,851718,851761,851762,851769,851770,51771,"
+    "851779,880211,880212,880220,880230,880240,880260,8411128009,8517610001,8517610002,8411910008,8411123006,8802300002,8802400011,8517,"
+    "8411121009,8411123008,8411826001,8411222008,8411110009,8802110002,8411810008,8517693100,8802120001,8411210001,8802200001,8802400036,"
+    "8411990019,8411810001,8411822008,8411910002,8802120009,8802300007,8411210009,8411228001,8411123009,8411990011,8802400018,8411910001,"
+    "8411110001,8411128002,8411828009,8411990098,8517110000,8517130000,8517140000,8517180000,8517610008,8517620002,8517620003,8517620009,"
+    "8517691000,8517692000,8517693900,8517699000,8517711100,8517711500,8517711900,8517790001,8517790009,8802200008,8411121001,8411228008,"
+    "8802400039,8802400034,8411822001,8411990091,8411990092,8802300003,8802110009,8517701100,8517709009,8802110003,8802601000,8517120000,"
+    "8517701500,8517701900,8517709001,8411222003,8802200002,8802"
+)
+
+
+def _seed_tnved_exclusions(cursor):
+    codes = sorted({c.strip() for c in DEFAULT_TNVED_EXCLUSIONS.split(",") if c.strip()})
+    execute_values(cursor, """
+        INSERT INTO tnved_exclusions (code) VALUES %s
+        ON CONFLICT (code) DO NOTHING;
+    """, [(c,) for c in codes])
+    return True
+
+
+# (version, name, function); a function returning False is skipped and
+# retried on the next start, e.g. when its feature flag is still off
+MIGRATIONS = [
+    (1, "download_history indexes", _history_indexes),
+    (2, "download_history monthly partitions", _history_partitioning),
+    (3, "seed tnved_exclusions", _seed_tnved_exclusions),
+]
+
+
+def _apply_migrations(conn, table, migrations, lock_id):
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            version INT PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
     """)
     conn.commit()
 
+    for version, name, migrate in migrations:
+        # several bot processes may start at once - migrate one at a time
+        cursor.execute("SELECT pg_advisory_xact_lock(%s);", (lock_id,))
+        cursor.execute(f"SELECT 1 FROM {table} WHERE version = %s;", (version,))
+        if cursor.fetchone() is None and migrate(cursor):
+            cursor.execute(f"""
+                INSERT INTO {table} (version, name) VALUES (%s, %s);
+            """, (version, name))
+            print(f"Applied migration {version}: {name}")
+        conn.commit()
+
     cursor.close()
-    conn.close()
 
 
-def register_user(telegram_id, username):
-    conn = get_users_connection()
-    cursor = conn.cursor()
+def apply_migrations():
+    with get_users_connection() as conn:
+        _apply_migrations(conn, "schema_migrations", MIGRATIONS, MIGRATIONS_LOCK_ID)
 
-    username_norm = username if username is not None else None
 
-    cursor.execute("""
-        INSERT INTO users (telegram_id, username)
-        VALUES (%s, %s)
-        ON CONFLICT (telegram_id) DO UPDATE
-            SET username = EXCLUDED.username;
-    """, (telegram_id, username_norm))
+def ensure_history_partitions():
+    with get_users_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT 1
+            FROM pg_partitioned_table pt
+            JOIN pg_class c ON c.oid = pt.partrelid
+            WHERE c.relname = 'download_history';
+        """)
+        if cursor.fetchone() is not None:
+            now = datetime.now()
+            _create_history_partitions(cursor, now, now + timedelta(days=31 * HISTORY_PARTITIONS_AHEAD))
+        conn.commit()
+        cursor.close()
 
-    conn.commit()
-    cursor.close()
-    conn.close()
+
+def register_user(telegram_id, username):
+    with get_users_connection() as conn:
+        cursor = conn.cursor()
+
+        username_norm = username if username is not None else None
+
+        cursor.execute("""
+            INSERT INTO users (telegram_id, username)
+            VALUES (%s, %s)
+            ON CONFLICT (telegram_id) DO UPDATE
+                SET username = EXCLUDED.username
+            RETURNING role;
+        """, (telegram_id, username_norm))
+        role = cursor.fetchone()[0]
+
+        conn.commit()
+        cursor.close()
+    return role
+
+
+def get_user(telegram_id):
+    with get_users_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT role, username
+            FROM users
+            WHERE telegram_id = %s;
+        """, (telegram_id,))
+        row = cursor.fetchone()
+        cursor.close()
+    return row
 
 
 def get_user_role(telegram_id):
-    conn = get_users_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT role
-        FROM users
-        WHERE telegram_id = %s;
-    """, (telegram_id,))
-    row = cursor.fetchone()
-    cursor.close()
-    conn.close()
+    with get_users_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT role
+            FROM users
+            WHERE telegram_id = %s;
+        """, (telegram_id,))
+        row = cursor.fetchone()
+        cursor.close()
     return row[0] if row else None
 
 
-async def change_user_role(telegram_id: int, new_role: str):
-    conn = get_users_connection()
-    cursor = conn.cursor()
+def change_user_role(telegram_id: int, new_role: str):
+    with get_users_connection() as conn:
+        cursor = conn.cursor()
 
-    cursor.execute("""
-        SELECT role, username
-        FROM users
-        WHERE telegram_id = %s;
-    """, (telegram_id,))
-    row = cursor.fetchone()
-
-    if not row:
-        reply = f"Пользователь с telegram_id={telegram_id} ещё ни разу не запускал бота."
-    else:
-        current_role, username = row
+        cursor.execute("""
+            SELECT role, username
+            FROM users
+            WHERE telegram_id = %s;
+        """, (telegram_id,))
+        row = cursor.fetchone()
 
-        if current_role == 'admin':
-            reply = "Вы не можете изменить роль супер админа."
+        if not row:
+            reply = f"Пользователь с telegram_id={telegram_id} ещё ни разу не запускал бота."
         else:
-            cursor.execute("""
-                UPDATE users
-                SET role = %s
-                WHERE telegram_id = %s AND role != 'admin';
-            """, (new_role, telegram_id))
-            reply = (
-                f"Роль пользователя "
-                f"{('@' + username) if username else f'id={telegram_id}'} "
-                f"успешно изменена на {new_role}."
-            )
-
-    conn.commit()
-    cursor.close()
-    conn.close()
+            current_role, username = row
+
+            if current_role == 'admin':
+                reply = "Вы не можете изменить роль супер админа."
+            else:
+                cursor.execute("""
+                    UPDATE users
+                    SET role = %s
+                    WHERE telegram_id = %s AND role != 'admin';
+                """, (new_role, telegram_id))
+                reply = (
+                    f"Роль пользователя "
+                    f"{('@' + username) if username else f'id={telegram_id}'} "
+                    f"успешно изменена на {new_role}."
+                )
+
+        conn.commit()
+        cursor.close()
     return reply
 
 
-async def add_download_history(telegram_id, partner, year):
-    conn = get_users_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT id FROM users WHERE telegram_id = %s;
-    """, (telegram_id,))
-    row = cursor.fetchone()
-    user_id = row[0] if row else None
-
-    cursor.execute("""
-        INSERT INTO download_history (user_id, partner, year)
-        VALUES (%s, %s, %s);
-    """, (user_id, partner, year))
-    conn.commit()
-    cursor.close()
-    conn.close()
+def add_download_history(telegram_id, partner, year):
+    with get_users_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id FROM users WHERE telegram_id = %s;
+        """, (telegram_id,))
+        row = cursor.fetchone()
+        user_id = row[0] if row else None
+
+        cursor.execute("""
+            INSERT INTO download_history (user_id, partner, year)
+            VALUES (%s, %s, %s);
+        """, (user_id, partner, year))
+        conn.commit()
+        cursor.close()
+
+def add_download_history_batch(events):
+    """events: [(telegram_id, partner, year, age_seconds)], age counted back from now."""
+    with get_users_connection() as conn:
+        cursor = conn.cursor()
+        execute_values(cursor, """
+            INSERT INTO download_history (user_id, partner, year, downloaded_at)
+            SELECT u.id, e.partner, e.year, CURRENT_TIMESTAMP - e.age * INTERVAL '1 second'
+            FROM (VALUES %s) AS e(telegram_id, partner, year, age)
+            LEFT JOIN users u ON u.telegram_id = e.telegram_id;
+        """, events, template="(%s::bigint, %s::text, %s::text, %s::float8)")
+        conn.commit()
+        cursor.close()
+
+def iter_download_history(date_from=None, date_to=None, username=None, batch_size=5000):
+    """Yield history rows newest first, fetched from a server-side cursor in batches."""
+    conditions = []
+    params = []
+    if date_from is not None:
+        conditions.append("h.downloaded_at >= %s")
+        params.append(date_from)
+    if date_to is not None:
+        conditions.append("h.downloaded_at < %s")
+        params.append(date_to)
+    if username is not None:
+        conditions.append("u.username = %s")
+        params.append(username)
+    where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+
+    with get_users_connection() as conn:
+        cursor = conn.cursor(name="download_history_export")
+        cursor.itersize = batch_size
+        cursor.execute(f"""
+            SELECT h.id, u.username, h.partner, h.year, h.downloaded_at
+            FROM download_history h
+            JOIN users u ON h.user_id = u.id
+            {where}
+            ORDER BY h.downloaded_at DESC, h.id DESC;
+        """, params)
+        for row in cursor:
+            yield row
+        cursor.close()
+        conn.rollback()
+
+def get_download_history_page(limit=20, before=None):
+    """Keyset page of history, newest first; ``before`` is (downloaded_at, id)
+    of the last row of the previous page."""
+    with get_users_connection() as conn:
+        cursor = conn.cursor()
+        if before is None:
+            cursor.execute("""
+                SELECT h.id, u.username, h.partner, h.year, h.downloaded_at
+                FROM download_history h
+                JOIN users u ON h.user_id = u.id
+                ORDER BY h.downloaded_at DESC, h.id DESC
+                LIMIT %s;
+            """, (limit,))
+        else:
+            cursor.execute("""
+                SELECT h.id, u.username, h.partner, h.year, h.downloaded_at
+                FROM download_history h
+                JOIN users u ON h.user_id = u.id
+                WHERE (h.downloaded_at, h.id) < (%s, %s)
+                ORDER BY h.downloaded_at DESC, h.id DESC
+                LIMIT %s;
+            """, (*before, limit))
+        rows = cursor.fetchall()
+        cursor.close()
+    return rows
 
-async def get_download_history():
-    conn = get_users_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT h.id, u.username, h.partner, h.year, h.downloaded_at
-        FROM download_history h
-        JOIN users u ON h.user_id = u.id  
-        ORDER BY h.downloaded_at DESC
-        LIMIT 100000;
-    """)
-    rows = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    reply = None
-    if not rows:
-        reply = "История скачиваний пуста."
-        return
+def get_users_for_export():
+    with get_users_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id, telegram_id, username, role
+            FROM users
+            ORDER BY id;
+        """)
+        rows = cursor.fetchall()
+        cursor.close()
+    return rows
 
-    return reply, rows
 
-async def get_users_for_export():
-    conn = get_users_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT id, telegram_id, username, role
-        FROM users
-        ORDER BY id;
-    """)
-    rows = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return rows
+def get_report_file(cache_key):
+    with get_users_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT status, filename, short_filename, file_id
+            FROM report_files
+            WHERE cache_key = %s;
+        """, (cache_key,))
+        row = cursor.fetchone()
+        cursor.close()
+    if not row:
+        return None
+    status, filename, short_filename, file_id = row
+    return {"status": status, "filename": filename, "short_filename": short_filename, "file_id": file_id}
+
+
+def save_report_file(cache_key, data_version, status, filename, short_filename, file_id):
+    with get_users_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO report_files (cache_key, data_version, status, filename, short_filename, file_id)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (cache_key) DO UPDATE
+                SET file_id = EXCLUDED.file_id,
+                    created_at = CURRENT_TIMESTAMP;
+        """, (cache_key, data_version, status, filename, short_filename, file_id))
+        # file_ids of reports built from older data will never be asked for again
+        cursor.execute("""
+            DELETE FROM report_files WHERE data_version <> %s;
+        """, (data_version,))
+        conn.commit()
+        cursor.close()
+
+
+def delete_report_file(cache_key):
+    with get_users_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            DELETE FROM report_files WHERE cache_key = %s;
+        """, (cache_key,))
+        conn.commit()
+        cursor.close()
+
+
+def load_fsm_record(chat, user):
+    with get_users_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT state, data, bucket
+            FROM fsm_states
+            WHERE chat = %s AND "user" = %s;
+        """, (chat, user))
+        row = cursor.fetchone()
+        cursor.close()
+    return row
+
+
+def save_fsm_records(records):
+    """records: [(chat, user, state, data, bucket)]; empty ones are deleted."""
+    upserts = [(c, u, st, Json(d), Json(b)) for c, u, st, d, b in records if st is not None or d or b]
+    deletes = [(c, u) for c, u, st, d, b in records if st is None and not d and not b]
+    with get_users_connection() as conn:
+        cursor = conn.cursor()
+        if upserts:
+            execute_values(cursor, """
+                INSERT INTO fsm_states (chat, "user", state, data, bucket)
+                VALUES %s
+                ON CONFLICT (chat, "user") DO UPDATE
+                    SET state = EXCLUDED.state,
+                        data = EXCLUDED.data,
+                        bucket = EXCLUDED.bucket,
+                        updated_at = CURRENT_TIMESTAMP;
+            """, upserts)
+        if deletes:
+            execute_values(cursor, """
+                DELETE FROM fsm_states f
+                USING (VALUES %s) AS d(chat, "user")
+                WHERE f.chat = d.chat AND f."user" = d."user";
+            """, deletes)
+        conn.commit()
+        cursor.close()
+
+
+def expire_fsm_records(ttl_seconds):
+    with get_users_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            DELETE FROM fsm_states
+            WHERE updated_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 second';
+        """, (ttl_seconds,))
+        deleted = cursor.rowcount
+        conn.commit()
+        cursor.close()
+    return deleted
+
+
+def get_tnved_exclusions():
+    with get_users_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT code FROM tnved_exclusions ORDER BY code;
+        """)
+        codes = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+    return codes
+
+
+def add_tnved_exclusions(codes):
+    with get_users_connection() as conn:
+        cursor = conn.cursor()
+        execute_values(cursor, """
+            INSERT INTO tnved_exclusions (code) VALUES %s
+            ON CONFLICT (code) DO NOTHING;
+        """, [(c,) for c in codes])
+        conn.commit()
+        cursor.close()
+
+
+def remove_tnved_exclusions(codes):
+    with get_users_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            DELETE FROM tnved_exclusions WHERE code = ANY(%s);
+        """, (list(codes),))
+        conn.commit()
+        cursor.close()
+
+
+def create_report_job(telegram_id, chat_id, priority, params, worker=None, per_user_limit=None):
+    """Insert a job; queued, or already running when ``worker`` runs it itself.
+    Returns the job id, or None when the user already has ``per_user_limit``
+    unfinished jobs."""
+    with get_users_connection() as conn:
+        cursor = conn.cursor()
+        if per_user_limit is not None:
+            # serialize enqueues of one user so two parallel clicks can't both pass
+            cursor.execute("SELECT pg_advisory_xact_lock(%s, %s);", (MIGRATIONS_LOCK_ID, telegram_id % 2 ** 31))
+            cursor.execute("""
+                SELECT count(*)
+                FROM report_jobs
+                WHERE telegram_id = %s AND state IN ('queued', 'running', 'done');
+            """, (telegram_id,))
+            if cursor.fetchone()[0] >= per_user_limit:
+                conn.rollback()
+                cursor.close()
+                return None
+        cursor.execute("""
+            INSERT INTO report_jobs (telegram_id, chat_id, priority, params, state, worker, attempts)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            RETURNING id;
+        """, (telegram_id, chat_id, priority, Json(params),
+              'running' if worker else 'queued', worker, 1 if worker else 0))
+        job_id = cursor.fetchone()[0]
+        conn.commit()
+        cursor.close()
+    return job_id
+
+
+def claim_report_job(worker, stale_after):
+    """Take the next queued job, or a running one whose worker stopped
+    sending heartbeats, for ``worker``."""
+    with get_users_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE report_jobs
+            SET state = 'running', worker = %s, attempts = attempts + 1, updated_at = CURRENT_TIMESTAMP
+            WHERE id = (
+                SELECT id
+                FROM report_jobs
+                WHERE state = 'queued'
+                   OR (state IN ('running', 'done') AND updated_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 second')
+                ORDER BY priority, id
+                FOR UPDATE SKIP LOCKED
+                LIMIT 1
+            )
+            RETURNING id, telegram_id, chat_id, priority, params, attempts, result_key;
+        """, (worker, stale_after))
+        row = cursor.fetchone()
+        conn.commit()
+        cursor.close()
+    return row
+
+
+def update_report_job(job_id, state, result_key=None, error=None):
+    with get_users_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE report_jobs
+            SET state = %s,
+                result_key = COALESCE(%s, result_key),
+                error = %s,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = %s;
+        """, (state, result_key, error, job_id))
+        conn.commit()
+        cursor.close()
+
+
+def heartbeat_report_jobs(job_ids):
+    with get_users_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE report_jobs SET updated_at = CURRENT_TIMESTAMP WHERE id = ANY(%s);
+        """, (list(job_ids),))
+        conn.commit()
+        cursor.close()
+
+
+def purge_report_jobs(keep_days):
+    with get_users_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            DELETE FROM report_jobs
+            WHERE state IN ('delivered', 'failed')
+              AND updated_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 day';
+        """, (keep_days,))
+        conn.commit()
+        cursor.close()
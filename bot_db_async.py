@@ -0,0 +1,75 @@
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bot_db
+import metrics
+from settings import DB_EXECUTOR_WORKERS
+
+
+# psycopg2 is blocking, so every call is shipped to a dedicated thread pool
+# and the aiogram loop keeps serving updates while Postgres answers.
+_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="bot_db")
+
+
+async def run(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+def _timed(func, submitted, *args, **kwargs):
+    started = time.perf_counter()
+    metrics.db_wait_seconds.observe(started - submitted)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        metrics.db_seconds.observe(time.perf_counter() - started, function=func.__name__)
+
+
+def _in_executor(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run(_timed, func, time.perf_counter(), *args, **kwargs)
+    return wrapper
+
+
+def shutdown():
+    _executor.shutdown(wait=True)
+
+
+notify = _in_executor(bot_db.notify)
+tnved_exists = _in_executor(bot_db.tnved_exists)
+get_regions = _in_executor(bot_db.get_regions)
+get_partners = _in_executor(bot_db.get_partners)
+get_years = _in_executor(bot_db.get_years)
+get_categories = _in_executor(bot_db.get_categories)
+get_subcategories = _in_executor(bot_db.get_subcategories)
+get_all_subcategories = _in_executor(bot_db.get_all_subcategories)
+get_tnved_codes = _in_executor(bot_db.get_tnved_codes)
+get_data_version = _in_executor(bot_db.get_data_version)
+rebuild_trade_aggregates = _in_executor(bot_db.rebuild_trade_aggregates)
+setup_users_tables = _in_executor(bot_db.setup_users_tables)
+register_user = _in_executor(bot_db.register_user)
+get_user_role = _in_executor(bot_db.get_user_role)
+get_user = _in_executor(bot_db.get_user)
+change_user_role = _in_executor(bot_db.change_user_role)
+add_download_history = _in_executor(bot_db.add_download_history)
+add_download_history_batch = _in_executor(bot_db.add_download_history_batch)
+get_users_for_export = _in_executor(bot_db.get_users_for_export)
+get_download_history_page = _in_executor(bot_db.get_download_history_page)
+ensure_history_partitions = _in_executor(bot_db.ensure_history_partitions)
+get_report_file = _in_executor(bot_db.get_report_file)
+save_report_file = _in_executor(bot_db.save_report_file)
+delete_report_file = _in_executor(bot_db.delete_report_file)
+load_fsm_record = _in_executor(bot_db.load_fsm_record)
+save_fsm_records = _in_executor(bot_db.save_fsm_records)
+expire_fsm_records = _in_executor(bot_db.expire_fsm_records)
+get_tnved_exclusions = _in_executor(bot_db.get_tnved_exclusions)
+add_tnved_exclusions = _in_executor(bot_db.add_tnved_exclusions)
+remove_tnved_exclusions = _in_executor(bot_db.remove_tnved_exclusions)
+create_report_job = _in_executor(bot_db.create_report_job)
+claim_report_job = _in_executor(bot_db.claim_report_job)
+update_report_job = _in_executor(bot_db.update_report_job)
+heartbeat_report_jobs = _in_executor(bot_db.heartbeat_report_jobs)
+purge_report_jobs = _in_executor(bot_db.purge_report_jobs)
@@ -0,0 +1,92 @@
+"""Cache invalidation across bot processes (polling bot, webhook workers,
+report_worker.py) through Postgres LISTEN/NOTIFY on the users DB.
+
+A change is published with ``publish(kind, key)``: it is applied in this
+process at once and sent as a NOTIFY to every other listening process.
+Each process runs ``listen()`` for as long as it lives. Notifications are
+not queued for a process while its listening connection is down, so every
+(re)connect drops all subscribed caches to be safe.
+"""
+import asyncio
+import json
+import os
+import socket
+
+import bot_db
+import bot_db_async
+
+
+CHANNEL = "bot_cache_events"
+RECONNECT_DELAY = 5
+
+ORIGIN = f"{socket.gethostname()}:{os.getpid()}"
+
+_subscribers = {}   # kind -> [callback(key)]; key None means everything
+
+
+def subscribe(kind, callback):
+    _subscribers.setdefault(kind, []).append(callback)
+
+
+def _apply(kind, key):
+    for callback in _subscribers.get(kind, ()):
+        try:
+            callback(key)
+        except Exception as e:
+            print(f"cache event {kind}:{key} failed: {e}")
+
+
+def _apply_all():
+    for kind in list(_subscribers):
+        _apply(kind, None)
+
+
+async def publish(kind, key=None):
+    _apply(kind, key)
+    await bot_db_async.notify(CHANNEL, json.dumps({"kind": kind, "key": key, "origin": ORIGIN}))
+
+
+def _on_payload(payload):
+    try:
+        event = json.loads(payload)
+    except ValueError:
+        return
+    if event.get("origin") != ORIGIN:   # our own events are applied already
+        _apply(event.get("kind"), event.get("key"))
+
+
+async def _listen_once(loop):
+    conn = await bot_db_async.run(bot_db.open_listen_connection, CHANNEL)
+    lost = loop.create_future()
+
+    def on_readable():
+        try:
+            conn.poll()
+        except Exception as e:
+            if not lost.done():
+                lost.set_exception(e)
+            return
+        while conn.notifies:
+            _on_payload(conn.notifies.pop(0).payload)
+
+    loop.add_reader(conn.fileno(), on_readable)
+    try:
+        # anything published while we were not listening is lost
+        _apply_all()
+        await lost
+    finally:
+        loop.remove_reader(conn.fileno())
+        conn.close()
+
+
+async def listen():
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await _listen_once(loop)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"cache events listener failed: {e}")
+        _apply_all()
+        await asyncio.sleep(RECONNECT_DELAY)
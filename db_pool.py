@@ -0,0 +1,180 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, dsn_kwargs, min_size=1, max_size=10, max_uses=1000,
+                 borrow_timeout=10, health_check_after=30):
+        self.dsn_kwargs = dsn_kwargs
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_uses = max_uses
+        self.borrow_timeout = borrow_timeout
+        self.health_check_after = health_check_after
+
+        self._idle = []   # [(conn, uses, returned_at)]
+        self._uses = {}   # id(conn) -> uses, for connections out of the pool
+        self._size = 0
+        self._cond = threading.Condition()
+        self._stats = {
+            "borrowed": 0,
+            "created": 0,
+            "recycled": 0,
+            "broken": 0,
+            "waits": 0,
+            "timeouts": 0,
+        }
+
+    def _connect(self):
+        conn = psycopg2.connect(**self.dsn_kwargs)
+        with self._cond:
+            self._stats["created"] += 1
+        return conn
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _drop(self, conn, reason):
+        # closing may block on the socket, so it happens outside the lock;
+        # the freed slot is published afterwards
+        self._close(conn)
+        with self._cond:
+            self._stats[reason] += 1
+            self._size -= 1
+            self._cond.notify()
+
+    def _is_healthy(self, conn, returned_at):
+        if conn.closed:
+            return False
+        if time.monotonic() - returned_at < self.health_check_after:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1;")
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def warm_up(self):
+        with self._cond:
+            missing = max(0, self.min_size - self._size)
+            self._size += missing
+        for _ in range(missing):
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._idle.append((conn, 0, time.monotonic()))
+                self._cond.notify()
+
+    def _reserve(self, deadline):
+        """Under the lock: an idle (conn, uses, returned_at), or None after
+        reserving a slot for a new connection."""
+        while True:
+            if self._idle:
+                return self._idle.pop()
+            if self._size < self.max_size:
+                self._size += 1
+                return None
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._stats["timeouts"] += 1
+                raise PoolTimeout(f"Не удалось получить соединение с БД за {self.borrow_timeout} с.")
+            self._stats["waits"] += 1
+            self._cond.wait(remaining)
+
+    def getconn(self):
+        # Only bookkeeping happens under the lock; connecting and health
+        # checks are network round trips and must not stall other threads.
+        deadline = time.monotonic() + self.borrow_timeout
+        while True:
+            with self._cond:
+                idle = self._reserve(deadline)
+
+            if idle is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                uses = 0
+            else:
+                conn, uses, returned_at = idle
+                if not self._is_healthy(conn, returned_at):
+                    self._drop(conn, "broken")
+                    continue
+
+            with self._cond:
+                self._uses[id(conn)] = uses + 1
+                self._stats["borrowed"] += 1
+            return conn
+
+    def putconn(self, conn):
+        with self._cond:
+            uses = self._uses.pop(id(conn), 0)
+        if conn.closed:
+            self._drop(conn, "broken")
+            return
+        if uses >= self.max_uses:
+            self._drop(conn, "recycled")
+            return
+        try:
+            if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except Exception:
+            self._drop(conn, "broken")
+            return
+        with self._cond:
+            self._idle.append((conn, uses, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        try:
+            yield conn
+        except Exception:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            raise
+        finally:
+            self.putconn(conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "max_size": self.max_size,
+                **self._stats,
+            }
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for conn, _, _ in idle:
+            self._close(conn)
@@ -0,0 +1,51 @@
+import re
+
+import bot_db_async
+import cache_events
+import ref_cache
+
+
+CODE_RE = re.compile(r"\d{4}|\d{6}|\d{10}")
+
+
+class Exclusions:
+    """TN VED codes left out of every report, parsed and validated once.
+
+    ``exclude_raw`` is the canonical comma string handed to the generator,
+    built from the valid codes only; ``invalid`` keeps what was rejected
+    so an admin can see and fix it.
+    """
+
+    def __init__(self, codes, index):
+        self.codes = frozenset(c for c in codes if CODE_RE.fullmatch(c) and c in index)
+        self.invalid = tuple(sorted(set(codes) - self.codes))
+        self.exclude_raw = ",".join(sorted(self.codes))
+
+
+async def _load():
+    codes = await bot_db_async.get_tnved_exclusions()
+    exclusions = Exclusions(codes, await ref_cache.get_tnved_index())
+    if exclusions.invalid:
+        print(f"Ignoring invalid TN VED exclusions: {', '.join(exclusions.invalid)}")
+    return exclusions
+
+
+async def get_exclusions():
+    return await ref_cache.ref_cache.get("tnved_exclusions", _load)
+
+async def get_exclude_raw():
+    return (await get_exclusions()).exclude_raw
+
+
+async def add_exclusions(codes):
+    index = await ref_cache.get_tnved_index()
+    valid = [c for c in codes if CODE_RE.fullmatch(c) and c in index]
+    if valid:
+        await bot_db_async.add_tnved_exclusions(valid)
+        await cache_events.publish("ref", "tnved_exclusions")
+    return valid, [c for c in codes if c not in valid]
+
+async def remove_exclusions(codes):
+    if codes:
+        await bot_db_async.remove_tnved_exclusions(codes)
+        await cache_events.publish("ref", "tnved_exclusions")
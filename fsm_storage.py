@@ -0,0 +1,172 @@
+import asyncio
+import copy
+import time
+from collections import OrderedDict
+
+from aiogram.dispatcher.storage import BaseStorage
+
+import bot_db_async
+from settings import FSM_FLUSH_INTERVAL, FSM_TTL, FSM_CACHE_SIZE
+
+
+class PostgresStorage(BaseStorage):
+    """FSM storage backed by the fsm_states table of the users DB.
+
+    Records are kept in a bounded LRU in memory and written back in batches
+    every ``flush_interval`` seconds, so a conversation step costs no DB
+    round-trip. Conversations idle for longer than ``ttl`` are dropped.
+    Several bot instances may share the table as long as each chat is
+    always routed to the same instance (see webhook.py).
+    """
+
+    def __init__(self, flush_interval=FSM_FLUSH_INTERVAL, ttl=FSM_TTL, cache_size=FSM_CACHE_SIZE):
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.cache_size = cache_size
+        # (chat, user) -> {"state", "data", "bucket", "touched"}
+        self._records = OrderedDict()
+        # (chat, user) -> record changed since the last flush; kept here
+        # even if the LRU has evicted it meanwhile
+        self._dirty = {}
+        # (chat, user) -> task loading that record, so concurrent updates
+        # of one chat share a single record instead of each loading its own
+        self._loading = {}
+        self._flush_task = None
+        self._last_expire = 0.0
+
+    @staticmethod
+    def _key(chat, user):
+        chat, user = BaseStorage.check_address(chat=chat, user=user)
+        return str(chat), str(user)
+
+    async def _get(self, chat, user):
+        key = self._key(chat, user)
+        record = self._records.get(key) or self._dirty.get(key)
+        if record is not None and time.monotonic() - record["touched"] > self.ttl:
+            record = None
+            self._records.pop(key, None)
+            self._dirty.pop(key, None)
+        if record is None:
+            record = await self._load(key)
+        if key in self._records:
+            record = self._records[key]
+            self._records.move_to_end(key)
+        else:
+            self._records[key] = record
+            await self._shrink()
+        return key, record
+
+    async def _load(self, key):
+        loading = self._loading.get(key)
+        if loading is None:
+            loading = self._loading[key] = asyncio.ensure_future(self._fetch(key))
+            loading.add_done_callback(lambda _: self._loading.pop(key, None))
+        return await asyncio.shield(loading)
+
+    @staticmethod
+    async def _fetch(key):
+        row = await bot_db_async.load_fsm_record(*key)
+        state, data, bucket = row if row else (None, {}, {})
+        return {"state": state, "data": data or {}, "bucket": bucket or {}, "touched": time.monotonic()}
+
+    def _mark_dirty(self, key, record):
+        record["touched"] = time.monotonic()
+        self._dirty[key] = record
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_loop())
+
+    async def _shrink(self):
+        if len(self._records) <= self.cache_size:
+            return
+        if self._dirty:
+            await self.flush()
+        while len(self._records) > self.cache_size:
+            self._records.popitem(last=False)
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        records = [(*key, r["state"], r["data"], r["bucket"]) for key, r in dirty.items()]
+        try:
+            await bot_db_async.save_fsm_records(records)
+        except Exception:
+            for key, record in dirty.items():
+                self._dirty.setdefault(key, record)
+            raise
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - self._last_expire > 60:
+                    self._last_expire = time.monotonic()
+                    await bot_db_async.expire_fsm_records(self.ttl)
+            except Exception as e:
+                print(f"FSM storage flush failed: {e}")
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+    async def wait_closed(self):
+        return True
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        _, record = await self._get(chat, user)
+        return record["state"] if record["state"] is not None else self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        _, record = await self._get(chat, user)
+        return copy.deepcopy(record["data"] or default or {})
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        key, record = await self._get(chat, user)
+        record["state"] = self.resolve_state(state)
+        self._mark_dirty(key, record)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        key, record = await self._get(chat, user)
+        record["data"] = copy.deepcopy(data or {})
+        self._mark_dirty(key, record)
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        if data is None:
+            data = {}
+        key, record = await self._get(chat, user)
+        record["data"].update(data, **kwargs)
+        self._mark_dirty(key, record)
+
+    async def reset_state(self, *, chat=None, user=None, with_data=True):
+        await self.set_state(chat=chat, user=user, state=None)
+        if with_data:
+            await self.set_data(chat=chat, user=user, data={})
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default=None):
+        _, record = await self._get(chat, user)
+        return copy.deepcopy(record["bucket"] or default or {})
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        key, record = await self._get(chat, user)
+        record["bucket"] = copy.deepcopy(bucket or {})
+        self._mark_dirty(key, record)
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        if bucket is None:
+            bucket = {}
+        key, record = await self._get(chat, user)
+        record["bucket"].update(bucket, **kwargs)
+        self._mark_dirty(key, record)
+
+
+def make_storage(kind):
+    if kind == "postgres":
+        return PostgresStorage()
+    from aiogram.contrib.fsm_storage.memory import MemoryStorage
+    return MemoryStorage()
@@ -1,33 +1,38 @@
-import sys
 import os
 import re
+import asyncio
 import pandas as pd
 from io import BytesIO
 from aiogram import types
 from aiogram.dispatcher import FSMContext
 from aiogram.types import Message, ReplyKeyboardRemove, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 from states import StartNewStates
-from bot_db import tnved_exists, get_partners, register_user, add_download_history, get_categories, get_subcategories, get_user_role, change_user_role, get_download_history, get_users_for_export
-from config import REPORT_MODULE_PATH
-sys.path.insert(0, REPORT_MODULE_PATH)
-
-from document_gen.generator import generate_trade_document # type: ignore
+from bot_db import get_pool_stats
+from bot_db_async import get_users_for_export, get_download_history_page, rebuild_trade_aggregates, get_user
+from auth_cache import register_user, get_user_role, change_user_role, auth_cache
+from history_export import export_download_history
+from history_args import parse_history_args, encode_history_cursor, decode_history_cursor
+from ref_cache import tnved_exists, suggest_tnved, is_partner, is_category, is_subcategory, refresh as refresh_ref_cache
+from keyboards import RESTART_KEYBOARD, CONFIRMATION_KEYBOARD, years_keyboard, categories_keyboard, subcategories_keyboard
+from partner_picker import get_partner_index
+from exclusions import get_exclude_raw, get_exclusions, add_exclusions, remove_exclusions
+from aiogram.utils.exceptions import TelegramAPIError
+from report_scheduler import UserLimitReached, PRIORITY_ADMIN, PRIORITY_USER
+from reports import get_report_stats, make_report_kwargs
+from report_jobs import create_job, run_job
+from settings import REPORT_JOBS_MODE, BATCH_MAX_REPORTS, TRADE_AGGREGATES
+from metrics import log_event
+from batch import parse_batch_spec, run_batch, BatchSpecError, BATCH_HELP
 
 years = ['2020','2021','2022','2023','2024','2025','2026']
 
-excluded_tnveds_string = (
-    "8411,841111,841112,841121,841122,841181,841182,841191,841199,851711,851712,851713,851714,851718,851761,851762,851769,851770,51771,"
-    "851779,880211,880212,880220,880230,880240,880260,8411128009,8517610001,8517610002,8411910008,8411123006,8802300002,8802400011,8517,"
-    "8411121009,8411123008,8411826001,8411222008,8411110009,8802110002,8411810008,8517693100,8802120001,8411210001,8802200001,8802400036,"
-    "8411990019,8411810001,8411822008,8411910002,8802120009,8802300007,8411210009,8411228001,8411123009,8411990011,8802400018,8411910001,"
-    "8411110001,8411128002,8411828009,8411990098,8517110000,8517130000,8517140000,8517180000,8517610008,8517620002,8517620003,8517620009,"
-    "8517691000,8517692000,8517693900,8517699000,8517711100,8517711500,8517711900,8517790001,8517790009,8802200008,8411121001,8411228008,"
-    "8802400039,8802400034,8411822001,8411990091,8411990092,8802300003,8802110009,8517701100,8517709009,8802110003,8802601000,8517120000,"
-    "8517701500,8517701900,8517709001,8411222003,8802200002,8802"
-)
+WAIT_TEXT = "❗Идет генерация справки. Пожалуйста, подождите.❗"
+
+PARTNER_PROMPT = "Выберите страну-партнёра для Республики Казахстан или введите часть названия для поиска:"
+
 
 async def access_settings_handler(message: types.Message):
-    role = get_user_role(message.from_user.id)
+    role = await get_user_role(message.from_user.id)
     if role != 'admin':
         await message.answer("У вас нет прав для управления доступами.")
         return
@@ -107,30 +112,187 @@ async def handle_access_data(message: types.Message, state: FSMContext):
 
 
 async def download_history_handler(message: types.Message):
-    role = get_user_role(message.from_user.id)
+    role = await get_user_role(message.from_user.id)
     if role != 'admin':
         await message.answer("У вас нет прав для просмотра истории.")
         return
 
-    get_download_history_reply, get_download_history_rows = await get_download_history()
+    try:
+        fmt, date_from, date_to, username = parse_history_args(message.get_args())
+    except ValueError:
+        await message.answer(
+            "Некорректные параметры.\n"
+            "Формат: <code>/history [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД] [@username] [csv]</code>\n\n"
+            "Пример: <code>/history 2025-01-01 2025-03-31 @analyst csv</code>",
+            parse_mode='html'
+        )
+        return
 
-    if get_download_history_reply:
-        await message.answer(f'{get_download_history_reply}')
-    df = pd.DataFrame(get_download_history_rows, columns=["ID", "Username", "Filter", "Year", "Downloaded At"])
-    output = BytesIO()
-    df.to_excel(output, index=False)
-    output.seek(0)
-    await message.answer_document(("download_history.xlsx", output))
+    filename, output, count = await export_download_history(fmt, date_from, date_to, username)
+    try:
+        if not count:
+            await message.answer("История скачиваний пуста.")
+            return
+        await message.answer_document((filename, output))
+    finally:
+        output.close()
 
 
+HISTORY_PAGE_SIZE = 20
+
+async def recent_history_handler(message: types.Message):
+    role = await get_user_role(message.from_user.id)
+    if role != 'admin':
+        await message.answer("У вас нет прав для просмотра истории.")
+        return
+    await send_history_page(message)
+
+
+async def recent_history_page_cb(cbq: CallbackQuery):
+    await cbq.answer()
+    role = await get_user_role(cbq.from_user.id)
+    if role != 'admin':
+        return
+    await cbq.message.edit_reply_markup(reply_markup=None)
+    try:
+        before = decode_history_cursor(cbq.data)
+    except ValueError:
+        # a button from before the cursor format changed
+        await cbq.message.answer("Кнопка устарела. Откройте историю заново: /history_recent")
+        return
+    await send_history_page(cbq.message, before=before)
+
+
+async def send_history_page(message, before=None):
+    rows = await get_download_history_page(HISTORY_PAGE_SIZE, before)
+    if not rows:
+        await message.answer("История скачиваний пуста." if before is None else "Больше записей нет.")
+        return
+
+    lines = [
+        f"{downloaded_at:%Y-%m-%d %H:%M} @{username}: {partner} ({year})"
+        for _, username, partner, year, downloaded_at in rows
+    ]
+    kb = None
+    if len(rows) == HISTORY_PAGE_SIZE:
+        last_id, _, _, _, last_at = rows[-1]
+        kb = InlineKeyboardMarkup()
+        kb.add(InlineKeyboardButton("Ещё", callback_data=encode_history_cursor(last_at, last_id)))
+    await message.answer("\n".join(lines), reply_markup=kb)
+
+
+async def pool_stats_handler(message: types.Message):
+    role = await get_user_role(message.from_user.id)
+    if role != 'admin':
+        await message.answer("У вас нет прав для просмотра статистики.")
+        return
+
+    lines = []
+    for name, st in {**get_pool_stats(), "reports": get_report_stats(), "auth": auth_cache.stats()}.items():
+        lines.append(f"<b>{name}</b>: " + ", ".join(f"{k}={v}" for k, v in st.items()))
+    await message.answer("\n".join(lines), parse_mode='html')
+
+
+async def refresh_cache_handler(message: types.Message):
+    role = await get_user_role(message.from_user.id)
+    if role != 'admin':
+        await message.answer("У вас нет прав для обновления справочников.")
+        return
+
+    st = await refresh_ref_cache()
+    await message.answer(
+        "Справочники обновлены.\n" + ", ".join(f"{k}={v}" for k, v in st.items())
+    )
+
+
+async def rebuild_aggregates_handler(message: types.Message):
+    role = await get_user_role(message.from_user.id)
+    if role != 'admin':
+        await message.answer("У вас нет прав для пересчёта агрегатов.")
+        return
+    if not TRADE_AGGREGATES:
+        await message.answer("Агрегаты выключены (TRADE_AGGREGATES в config.py).")
+        return
+
+    await message.answer("Пересчитываю агрегаты...")
+    count = await rebuild_trade_aggregates()
+    st = await refresh_ref_cache()
+    await message.answer(
+        f"Агрегаты пересчитаны: {count} строк.\n" + ", ".join(f"{k}={v}" for k, v in st.items())
+    )
+
+
+async def exclusions_handler(message: types.Message):
+    role = await get_user_role(message.from_user.id)
+    if role != 'admin':
+        await message.answer("У вас нет прав для управления исключениями.")
+        return
+
+    args = (message.get_args() or "").replace(",", " ").split()
+    if args and args[0].lower() in ("add", "remove"):
+        action, codes = args[0].lower(), args[1:]
+        if not codes:
+            await message.answer("Укажите коды ТН ВЭД. Пример: <code>/exclusions add 8411 851711</code>", parse_mode='html')
+            return
+        if action == "add":
+            added, rejected = await add_exclusions(codes)
+            reply = f"Добавлено кодов: {len(added)}."
+            if rejected:
+                reply += f"\nНе найдены в справочнике ТН ВЭД: {', '.join(rejected)}"
+        else:
+            await remove_exclusions(codes)
+            reply = f"Удалено кодов: {len(codes)}."
+        await message.answer(reply)
+        return
+
+    excl = await get_exclusions()
+    reply = (
+        f"Исключённые коды ТН ВЭД ({len(excl.codes)}):\n"
+        f"<code>{excl.exclude_raw or '—'}</code>"
+    )
+    if excl.invalid:
+        reply += f"\n\nНекорректные коды (не применяются): <code>{', '.join(excl.invalid)}</code>"
+    reply += "\n\nИзменить: <code>/exclusions add|remove код ...</code>"
+    await message.answer(reply, parse_mode='html')
+
+
+async def batch_handler(message: types.Message):
+    role = await get_user_role(message.from_user.id)
+    if role != 'admin':
+        await message.answer("У вас нет прав для пакетной генерации.")
+        return
+
+    try:
+        combos = await parse_batch_spec(message.text or "", years)
+    except BatchSpecError as e:
+        await message.answer(f"{e}\n\n{BATCH_HELP}", parse_mode='html')
+        return
+    if not combos:
+        await message.answer(BATCH_HELP, parse_mode='html')
+        return
+    if len(combos) > BATCH_MAX_REPORTS:
+        await message.answer(f"Слишком много справок в одном пакете: {len(combos)}. Максимум – {BATCH_MAX_REPORTS}.")
+        return
+
+    # runs in the background so the chat keeps responding meanwhile
+    task = asyncio.ensure_future(run_batch(message, message.from_user.id, combos))
+    task.add_done_callback(lambda t: _report_batch_failure(message, t))
+
+
+def _report_batch_failure(message, task):
+    if task.cancelled() or task.exception() is None:
+        return
+    e = task.exception()
+    print(f"batch failed: {e!r}")
+    asyncio.ensure_future(message.answer(f"Пакетная генерация прервана из-за ошибки:\n{e}"))
+
 
 async def start_new_handler(message: types.Message, state: FSMContext, user=None):
     await state.finish()
     user = user or message.from_user
     telegram_id = user.id
     username = user.username or f"user_{telegram_id}"
-    register_user(telegram_id, username.strip())
-    role = get_user_role(telegram_id)
+    role = await register_user(telegram_id, username.strip())
     if role not in ['admin', 'advanced']:
         await message.reply("У вас нет прав для использования бота.")
         return
@@ -154,14 +316,6 @@ async def start_new_variant_chosen(cbq: CallbackQuery, state: FSMContext):
     data = cbq.data
     await cbq.message.edit_reply_markup(reply_markup=None)
 
-    partners = get_partners()
-
-    partners_kb = ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    partners_kb.add(KeyboardButton("Начать заново"))
-    for p in partners:
-        partners_kb.add(KeyboardButton(p))
-    
-
     if data == "cancel_cb":
         await cbq.message.answer("Чтобы начать заново, нажмите /start")
         await state.finish()
@@ -169,22 +323,26 @@ async def start_new_variant_chosen(cbq: CallbackQuery, state: FSMContext):
 
     if data == "plane_cb":
         await state.update_data(plain=1, tn_ved="", subcategory=None)
-        await cbq.message.answer("Выберите страну-партнёра для Республики Казахстан:", reply_markup=partners_kb)
+        await cbq.message.answer(PARTNER_PROMPT, reply_markup=(await get_partner_index()).letters_markup())
         await StartNewStates.choosing_partner.set()
 
     if data == "country_cb":
         await state.update_data(plain=0, tn_ved="", subcategory=None)
-        await cbq.message.answer("Выберите страну-партнёра для Республики Казахстан:", reply_markup=partners_kb)
+        await cbq.message.answer(PARTNER_PROMPT, reply_markup=(await get_partner_index()).letters_markup())
         await StartNewStates.choosing_partner.set()
 
     if data == "product_cb":
         await state.update_data(plain=0, tn_ved="", subcategory=None)
-        keyboard = ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-        keyboard.add(KeyboardButton("Начать заново"))
-        await cbq.message.answer("Введите код ТН ВЭД. Код ТН ВЭД должен состоять только из цифр и быть длиной 4, 6 или 10 знаков.", reply_markup=keyboard)
+        await cbq.message.answer("Введите код ТН ВЭД. Код ТН ВЭД должен состоять только из цифр и быть длиной 4, 6 или 10 знаков.", reply_markup=RESTART_KEYBOARD)
         await StartNewStates.waiting_for_tnved.set()
 
 
+def tnved_suggestions_text(codes):
+    if not codes:
+        return ""
+    return "\n\nВозможно, вы имели в виду:\n" + "\n".join(f"<code>{c}</code>" for c in codes)
+
+
 async def start_new_waiting_tnved(message: Message, state: FSMContext):
     txt = (message.text or "").strip()
     if txt.lower() == "начать заново":
@@ -192,21 +350,22 @@ async def start_new_waiting_tnved(message: Message, state: FSMContext):
         return
 
     if not re.fullmatch(r"(?:\d{4}|\d{6}|\d{10})", txt):
-        await message.answer("Неверный формат ТН ВЭД. Код ТН ВЭД должен состоять только из цифр и быть длиной 4, 6 или 10 знаков.")
+        reply = "Неверный формат ТН ВЭД. Код ТН ВЭД должен состоять только из цифр и быть длиной 4, 6 или 10 знаков."
+        if txt.isdigit():
+            reply += tnved_suggestions_text(await suggest_tnved(txt))
+        await message.answer(reply, parse_mode='html')
         return
     
-    if not tnved_exists(txt):
-        await message.answer("Такого кода ТН ВЭД нет в базе. Проверьте правильность ввода.")
+    if not await tnved_exists(txt):
+        reply = "Такого кода ТН ВЭД нет в базе. Проверьте правильность ввода."
+        reply += tnved_suggestions_text(await suggest_tnved(txt))
+        await message.answer(reply, parse_mode='html')
         return
 
     await state.update_data(tn_ved=txt, digit=len(txt), partner='весь мир')
 
     
-    kb = ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    kb.add(KeyboardButton("Начать заново"))
-    for y in years:
-        kb.add(KeyboardButton(str(y)))
-    await message.answer("Выберите год:", reply_markup=kb)
+    await message.answer("Выберите год:", reply_markup=years_keyboard(years))
     await StartNewStates.choosing_year.set()
 
 
@@ -216,18 +375,45 @@ async def start_new_partner(message: Message, state: FSMContext):
         await start_new_handler(message, state)
         return
 
-    partners = get_partners()
-    if txt not in partners:
-        await message.answer("Такого партнёра нет. Пожалуйста, выберите из предложенного списка.")
+    if await is_partner(txt):
+        await partner_chosen(message, state, txt)
         return
-    await state.update_data(partner=txt)
 
-    
-    kb = ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    kb.add(KeyboardButton("Начать заново"))
-    for y in years:
-        kb.add(KeyboardButton(str(y)))
-    await message.answer("Выберите год:", reply_markup=kb)
+    index = await get_partner_index()
+    found = index.search(txt)
+    if not found:
+        await message.answer("Такого партнёра нет. Попробуйте другое название или выберите из списка.", reply_markup=index.letters_markup())
+        return
+    await message.answer("Найденные партнёры:", reply_markup=index.results_markup(found))
+
+
+async def start_new_partner_cb(cbq: CallbackQuery, state: FSMContext):
+    await cbq.answer()
+    parts = cbq.data.split(":")
+
+    if parts[1] == "R":
+        await cbq.message.edit_reply_markup(reply_markup=None)
+        await start_new_handler(cbq.message, state, user=cbq.from_user)
+        return
+
+    index = await get_partner_index()
+    if parts[2] != index.version:
+        await cbq.message.edit_text("Список партнёров обновился. " + PARTNER_PROMPT, reply_markup=index.letters_markup())
+        return
+
+    if parts[1] == "L":
+        await cbq.message.edit_reply_markup(reply_markup=index.letters_markup())
+    elif parts[1] == "B":
+        await cbq.message.edit_reply_markup(reply_markup=index.bucket_markup(int(parts[3]), int(parts[4])))
+    elif parts[1] == "P":
+        partner = index.partners[int(parts[3])]
+        await cbq.message.edit_text(f"Страна-партнёр: <b>{partner}</b>", parse_mode="HTML")
+        await partner_chosen(cbq.message, state, partner)
+
+
+async def partner_chosen(message: Message, state: FSMContext, partner):
+    await state.update_data(partner=partner)
+    await message.answer("Выберите год:", reply_markup=years_keyboard(years))
     await StartNewStates.choosing_year.set()
 
 
@@ -248,11 +434,7 @@ async def start_new_year(message: Message, state: FSMContext):
     plain = int(data.get("plain") or 0)
 
     if plain == 1 or tn_ved:
-        kb = InlineKeyboardMarkup()
-        kb.add(
-            InlineKeyboardButton("Подтвердить", callback_data="sn_confirm"),
-            InlineKeyboardButton("Отмена", callback_data="sn_restart"),
-        )
+        kb = CONFIRMATION_KEYBOARD
 
         summary = []
         summary.append(f"Вы выбрали:")
@@ -271,13 +453,7 @@ async def start_new_year(message: Message, state: FSMContext):
         await StartNewStates.confirmation.set()
         return
 
-    categories = get_categories()
-    kb = ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    kb.add(KeyboardButton("Начать заново"))
-    kb.add(KeyboardButton("Без категории"))
-    for c in categories:
-        kb.add(KeyboardButton(c))
-    await message.answer("Введите категорию:", reply_markup=kb)
+    await message.answer("Введите категорию:", reply_markup=await categories_keyboard())
     await StartNewStates.choosing_category.set()
 
 
@@ -289,11 +465,7 @@ async def start_new_category(message: Message, state: FSMContext):
 
     if txt.startswith("Без категории"):
         await state.update_data(subcategory="")
-        kb = InlineKeyboardMarkup()
-        kb.add(
-            InlineKeyboardButton("Подтвердить", callback_data="sn_confirm"),
-            InlineKeyboardButton("Отмена", callback_data="sn_restart"),
-        )
+        kb = CONFIRMATION_KEYBOARD
         d = await state.get_data()
         await message.answer(
             f"Вы выбрали:\n"
@@ -307,22 +479,17 @@ async def start_new_category(message: Message, state: FSMContext):
         await StartNewStates.confirmation.set()
         return
 
-    categories = get_categories()
-    if txt not in categories:
+    if not await is_category(txt):
         await message.answer("Такой категории нет. Пожалуйста, выберите из предложенного списка.")
         return
 
     await state.update_data(category_parent=txt)
-    subcats = get_subcategories(txt)
-    if not subcats:
+    subcats_kb = await subcategories_keyboard(txt)
+    if subcats_kb is None:
         await message.answer("В выбранной вами категории нет подкатегорий. Пожалуйста, выберите другую категорию.")
         return
 
-    kb = ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    kb.add(KeyboardButton("Начать заново"))
-    for sc in subcats:
-        kb.add(KeyboardButton(sc))
-    await message.answer("Выберите подкатегорию:", reply_markup=kb)
+    await message.answer("Выберите подкатегорию:", reply_markup=subcats_kb)
     await StartNewStates.choosing_subcategory.set()
 
 
@@ -333,18 +500,13 @@ async def start_new_subcategory(message: Message, state: FSMContext):
         return
 
     d = await state.get_data()
-    subcats = get_subcategories(d.get("category_parent"))
-    if txt not in subcats:
+    if not await is_subcategory(d.get("category_parent"), txt):
         await message.answer("Такой подкатегории нет. Пожалуйста, выберите из предложенного списка.")
         return
 
     await state.update_data(subcategory=txt)
 
-    kb = InlineKeyboardMarkup()
-    kb.add(
-        InlineKeyboardButton("Подтвердить", callback_data="sn_confirm"),
-        InlineKeyboardButton("Отмена", callback_data="sn_restart"),
-    )
+    kb = CONFIRMATION_KEYBOARD
     d = await state.get_data()
     await message.answer(
         f"Вы выбрали:\n"
@@ -378,79 +540,68 @@ async def finalize_report_start_new(msg_or_cbq, state, tg_user):
     year = int(d.get('year'))
     tn_ved = ((d.get("tn_ved")).strip() or None)
     subcategory = (d.get("subcategory") or None)
-    long_report=0
-    if tn_ved:
-        subcategory = None
-        long_report=1
     plain=int(d.get("plain") or 0)
 
     if isinstance(msg_or_cbq, types.CallbackQuery):
-        await msg_or_cbq.message.answer("❗Идет генерация справки. Пожалуйста, подождите.❗", reply_markup=ReplyKeyboardRemove())
+        target = msg_or_cbq.message
     else:
-        await msg_or_cbq.answer("❗Идет генерация справки. Пожалуйста, подождите.❗", reply_markup=ReplyKeyboardRemove())
-    print(f'\nChosen data: partner={partner}, year={year}, sub={subcategory}, tn_ved={tn_ved}, long={long_report}, plain={plain}\n')
+        target = msg_or_cbq
+
+    # straight from the DB, not the /start-time role or the auth cache: a
+    # demoted user must not get a report out of a conversation begun before
+    row = await get_user(telegram_id)
+    role = row[0] if row else None
+    if role not in ['admin', 'advanced']:
+        await target.answer("У вас нет прав для использования бота.", reply_markup=ReplyKeyboardRemove())
+        await state.finish()
+        return
+
+    log_event("report_requested", telegram_id=telegram_id, partner=partner, year=year, subcategory=subcategory, tn_ved=tn_ved, plain=plain)
+    report_kwargs, hist_txt = make_report_kwargs(partner, year, tn_ved, subcategory, plain, await get_exclude_raw())
+
+    priority = PRIORITY_ADMIN if role == 'admin' else PRIORITY_USER
+    params = {"kwargs": report_kwargs, "hist_txt": hist_txt, "year": year, "role": role}
+    run_here = REPORT_JOBS_MODE != 'queue'
     try:
-        res = generate_trade_document(
-            region="Республика Казахстан",
-            country_or_group=partner,
-            start_year=None,
-            end_year=year,
-            digit=4,
-            category=subcategory,
-            text_size=7,
-            table_size=25,
-            country_table_size=15,
-            tn_ved=tn_ved,
-            month_range_raw="",
-            exclude_raw=excluded_tnveds_string,
-            long_report=long_report,
-            plain=plain,
-            include_regions=0,
-            change_color=1,
-        )
-        
-    except Exception as e:
-        print(f"\n!!! oh no, error occured:\n{e}\n\n")
-        if isinstance(msg_or_cbq, types.CallbackQuery):
-            await msg_or_cbq.message.answer("Произошла ошибка при генерации файла. Чтобы начать заново, нажмите /start")
-            if d.get("user_role") == 'admin':
-                await msg_or_cbq.message.answer(f"!!! oh no, error occured:\n{e}")
-            await state.finish()
-        else:
-            await msg_or_cbq.answer("Произошла ошибка при генерации файла. Чтобы начать заново, нажмите /start")
-            if d.get("user_role") == 'admin':
-                await msg_or_cbq.answer(f"!!! oh no, error occured:\n{e}")
-            await state.finish()
-        return
-
-    if res["status"] != 'no_data':
-        doc = res["doc"]
-        filename = res["filename"]
-        short_filename = res["short_filename"]
-        buf = BytesIO(); doc.save(buf); buf.seek(0)
-        if isinstance(msg_or_cbq, types.CallbackQuery):
-            await msg_or_cbq.message.answer_document((short_filename, buf))
-            await msg_or_cbq.message.answer(f"Ваш документ {filename} готов. Чтобы начать заново, нажмите /start")
-        else:
-            await msg_or_cbq.answer_document((short_filename, buf))
-            await msg_or_cbq.answer(f"Ваш документ {filename} готов. Чтобы начать заново, нажмите /start")
-        
-        no_tn_ved = "None"
-        no_subcategory = "None"
-        no_plain = "None"
-        if tn_ved:
-            no_tn_ved = tn_ved
-        if subcategory:
-            no_subcategory = subcategory
-        if plain !=0:
-            no_plain = "Самолётик"
-        hist_txt = partner +' '+ no_tn_ved +' '+ no_subcategory +' '+ no_plain
-        print(hist_txt)
-        await add_download_history(telegram_id, hist_txt, year)
+        job_id = await create_job(telegram_id, target.chat.id, priority, params, run_here)
+    except UserLimitReached:
+        await target.answer("У вас уже генерируются другие справки. Дождитесь их готовности и повторите попытку. Чтобы начать заново, нажмите /start", reply_markup=ReplyKeyboardRemove())
         await state.finish()
-    else:
-        if isinstance(msg_or_cbq, types.CallbackQuery):
-            await msg_or_cbq.message.answer("По выбранным фильтрам нет данных. Чтобы начать заново, нажмите /start")
-        else:
-            await msg_or_cbq.answer("По выбранным фильтрам нет данных. Чтобы начать заново, нажмите /start")
+        return
+
+    if not run_here:
+        await target.answer("❗Справка поставлена в очередь. Документ придёт в этот чат, как только будет готов.❗", reply_markup=ReplyKeyboardRemove())
         await state.finish()
+        return
+
+    await target.answer(WAIT_TEXT, reply_markup=ReplyKeyboardRemove())
+
+    # Messages sent with a reply keyboard (even ReplyKeyboardRemove) cannot
+    # be edited, so the queue position lives in a separate plain message,
+    # sent only if the report actually has to wait.
+    queue_msg = None
+    queue_lock = asyncio.Lock()
+
+    async def on_progress(position):
+        nonlocal queue_msg
+        text = f"Ваша справка в очереди: {position}" if position else "Ваша справка генерируется."
+        async with queue_lock:
+            try:
+                if queue_msg is not None:
+                    await queue_msg.edit_text(text)
+                elif position:
+                    queue_msg = await target.answer(text)
+            except TelegramAPIError:
+                pass
+
+    await state.finish()
+    # The render can take minutes; running it detached releases the update
+    # (and, in webhook mode, the chat's ordering lock), so /start and
+    # "Начать заново" keep working meanwhile.
+    task = asyncio.ensure_future(run_job(job_id, telegram_id, priority, params, target, on_progress))
+    task.add_done_callback(_report_job_failure)
+
+
+def _report_job_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        print(f"report job failed: {task.exception()!r}")
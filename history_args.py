@@ -0,0 +1,32 @@
+from datetime import datetime, timedelta
+
+
+CURSOR_FORMAT = "%Y%m%d%H%M%S%f"
+
+
+def parse_history_args(args):
+    fmt, username, dates = "xlsx", None, []
+    for arg in (args or "").split():
+        if arg.lower() == "csv":
+            fmt = "csv"
+        elif arg.startswith("@"):
+            username = arg[1:]
+        else:
+            dates.append(datetime.strptime(arg, "%Y-%m-%d"))
+    if len(dates) > 2:
+        raise ValueError("too many dates")
+    date_from = dates[0] if dates else None
+    # the end date is inclusive
+    date_to = dates[1] + timedelta(days=1) if len(dates) == 2 else None
+    return fmt, date_from, date_to, username
+
+
+def encode_history_cursor(downloaded_at, row_id):
+    # no colons in the timestamp, so the callback data splits unambiguously
+    return f"hist:{downloaded_at:{CURSOR_FORMAT}}:{row_id}"
+
+
+def decode_history_cursor(data):
+    """(downloaded_at, id) of the last row shown, from ``hist:...`` callback data."""
+    _, ts, row_id = data.split(":")
+    return datetime.strptime(ts, CURSOR_FORMAT), int(row_id)
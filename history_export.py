@@ -0,0 +1,74 @@
+import csv
+import gzip
+import io
+import tempfile
+
+import xlsxwriter
+
+import bot_db
+import bot_db_async
+from settings import HISTORY_BATCH_SIZE, HISTORY_SPOOL_MAX_BYTES
+
+
+HEADER = ["ID", "Username", "Filter", "Year", "Downloaded At"]
+
+# an xlsx sheet holds 1,048,576 rows; xlsxwriter silently drops the rest
+XLSX_SHEET_ROWS = 1048576 - 1
+
+
+def _write_xlsx(rows, out):
+    # constant_memory flushes every finished row to a temp file, so the
+    # workbook never holds more than one row in memory
+    workbook = xlsxwriter.Workbook(out, {"constant_memory": True})
+    date_format = workbook.add_format({"num_format": "yyyy-mm-dd hh:mm:ss"})
+    worksheet = None
+    count = 0
+    for count, (row_id, username, partner, year, downloaded_at) in enumerate(rows, start=1):
+        row = (count - 1) % XLSX_SHEET_ROWS + 1
+        if row == 1:
+            # the history continues on a new sheet
+            worksheet = workbook.add_worksheet()
+            worksheet.write_row(0, 0, HEADER)
+            worksheet.set_column(4, 4, 20)
+        worksheet.write_row(row, 0, (row_id, username, partner, year))
+        if downloaded_at is not None:
+            worksheet.write_datetime(row, 4, downloaded_at, date_format)
+    if worksheet is None:
+        workbook.add_worksheet().write_row(0, 0, HEADER)
+    workbook.close()
+    return count
+
+
+def _write_csv_gz(rows, out):
+    count = 0
+    with gzip.GzipFile(fileobj=out, mode="wb") as gz:
+        text = io.TextIOWrapper(gz, encoding="utf-8", newline="")
+        writer = csv.writer(text)
+        writer.writerow(HEADER)
+        for count, row in enumerate(rows, start=1):
+            writer.writerow(row)
+        text.flush()
+        text.detach()
+    return count
+
+
+def _export(fmt, date_from, date_to, username):
+    rows = bot_db.iter_download_history(date_from, date_to, username, batch_size=HISTORY_BATCH_SIZE)
+    out = tempfile.SpooledTemporaryFile(max_size=HISTORY_SPOOL_MAX_BYTES)
+    try:
+        if fmt == "csv":
+            count = _write_csv_gz(rows, out)
+            filename = "download_history.csv.gz"
+        else:
+            count = _write_xlsx(rows, out)
+            filename = "download_history.xlsx"
+    except Exception:
+        out.close()
+        raise
+    out.seek(0)
+    return filename, out, count
+
+
+async def export_download_history(fmt="xlsx", date_from=None, date_to=None, username=None):
+    """Returns (filename, file object, row count); the caller closes the file."""
+    return await bot_db_async.run(_export, fmt, date_from, date_to, username)
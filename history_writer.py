@@ -0,0 +1,83 @@
+import asyncio
+import time
+
+import bot_db_async
+from settings import HISTORY_FLUSH_SIZE, HISTORY_FLUSH_INTERVAL, HISTORY_BUFFER_MAX, HISTORY_PARTITIONS_CHECK_INTERVAL
+
+
+class HistoryWriter:
+    """Buffers download_history events and inserts them in batches from a
+    background task, every ``flush_size`` events or ``flush_interval`` seconds."""
+
+    def __init__(self, flush_size=HISTORY_FLUSH_SIZE, flush_interval=HISTORY_FLUSH_INTERVAL, max_buffer=HISTORY_BUFFER_MAX):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.dropped = 0
+        self._buffer = []   # [(telegram_id, partner, year, monotonic time)]
+        self._wakeup = None
+        self._task = None
+
+    def add(self, telegram_id, partner, year):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+        self._buffer.append((telegram_id, partner, str(year), time.monotonic()))
+        if len(self._buffer) > self.max_buffer:
+            # the DB has been unreachable for a long time - keep the newest events
+            self.dropped += len(self._buffer) - self.max_buffer
+            del self._buffer[:len(self._buffer) - self.max_buffer]
+        if len(self._buffer) >= self.flush_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        batch, self._buffer = self._buffer, []
+        now = time.monotonic()
+        try:
+            await bot_db_async.add_download_history_batch(
+                [(telegram_id, partner, year, now - at) for telegram_id, partner, year, at in batch]
+            )
+        except Exception:
+            self._buffer[:0] = batch
+            raise
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"download_history flush failed: {e}")
+
+    def stats(self):
+        return {"buffered": len(self._buffer), "dropped": self.dropped}
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+
+history_writer = HistoryWriter()
+
+
+async def add_download_history(telegram_id, partner, year):
+    history_writer.add(telegram_id, partner, year)
+
+
+async def maintain_history_partitions(interval=HISTORY_PARTITIONS_CHECK_INTERVAL):
+    """Keep HISTORY_PARTITIONS_AHEAD monthly partitions ahead of now for as
+    long as the bot runs, not only as of its start."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await bot_db_async.ensure_history_partitions()
+        except Exception as e:
+            print(f"download_history partitions check failed: {e}")
@@ -0,0 +1,77 @@
+import json
+
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+
+import ref_cache
+
+
+RESTART_BUTTON = "Начать заново"
+NO_CATEGORY_BUTTON = "Без категории"
+
+
+def serialize(markup):
+    # aiogram sends a str reply_markup as is, so a prebuilt keyboard
+    # costs no object allocations or json encoding per message
+    return json.dumps(markup.to_python(), ensure_ascii=False)
+
+
+def build_reply_keyboard(buttons, *leading):
+    kb = ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
+    for text in (RESTART_BUTTON, *leading):
+        kb.add(KeyboardButton(text))
+    for text in buttons:
+        kb.add(KeyboardButton(str(text)))
+    return serialize(kb)
+
+
+def _confirmation_keyboard():
+    kb = InlineKeyboardMarkup()
+    kb.add(
+        InlineKeyboardButton("Подтвердить", callback_data="sn_confirm"),
+        InlineKeyboardButton("Отмена", callback_data="sn_restart"),
+    )
+    return serialize(kb)
+
+
+RESTART_KEYBOARD = build_reply_keyboard([])
+CONFIRMATION_KEYBOARD = _confirmation_keyboard()
+
+
+class _Keyboards:
+    """Serialized keyboards rebuilt only when ref_cache hands out a new
+    source list (i.e. after a reload), checked by identity."""
+
+    def __init__(self):
+        self._built = {}   # name -> (source object, payload)
+
+    def get(self, name, source, build):
+        entry = self._built.get(name)
+        if entry is None or entry[0] is not source:
+            entry = (source, build(source))
+            self._built[name] = entry
+        return entry[1]
+
+
+_keyboards = _Keyboards()
+
+
+def years_keyboard(years):
+    return _keyboards.get("years", years, build_reply_keyboard)
+
+
+async def categories_keyboard():
+    categories = await ref_cache.get_categories()
+    return _keyboards.get("categories", categories, lambda c: build_reply_keyboard(c, NO_CATEGORY_BUTTON))
+
+
+async def subcategories_keyboard(parent_name):
+    subcategories = await ref_cache.get_subcategories(parent_name)
+    if not subcategories:
+        return None
+    return _keyboards.get(f"subcategories:{parent_name}", subcategories, build_reply_keyboard)
+
+
+async def warm_up():
+    await categories_keyboard()
+    for category in await ref_cache.get_categories():
+        await subcategories_keyboard(category)
@@ -0,0 +1,162 @@
+"""In-process metrics in the Prometheus text format, plus structured logs.
+
+Histograms and counters are plain objects guarded by a lock, because DB
+timings are recorded from the bot_db executor threads. Gauges are read
+from the existing ``stats()`` of pools and caches at scrape time, so the
+hot path pays nothing for them. ``start_server()`` serves everything on
+``http://METRICS_HOST:METRICS_PORT/metrics``.
+"""
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from settings import METRICS_HOST, METRICS_PORT, METRICS_LOG
+
+
+# seconds; reports take tens of seconds, DB calls and handlers milliseconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+log = logging.getLogger("metrics")
+
+# set by webhook workers so every process serves metrics on its own port
+port_offset = 0
+
+_lock = threading.Lock()
+_metrics = {}   # name -> metric, in registration order
+_collectors = []   # callables returning {(gauge name, labels): value}
+
+
+def _labels_text(labels):
+    if not labels:
+        return ""
+    items = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels)
+    return "{" + items + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, doc):
+        self.name = name
+        self.doc = doc
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, key, value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, doc, buckets=BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.buckets = buckets
+        self._values = {}   # labels -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, seconds, **labels):
+        key = tuple(sorted(labels.items()))
+        i = bisect_left(self.buckets, seconds)
+        with _lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            counts[i] += 1
+            counts[-1] += seconds
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        for key, counts in self._values.items():
+            cumulative = 0
+            for bound, n in zip((*self.buckets, "+Inf"), counts):
+                cumulative += n
+                yield self.name + "_bucket", key + (("le", bound),), cumulative
+            yield self.name + "_count", key, cumulative
+            yield self.name + "_sum", key, round(counts[-1], 6)
+
+
+def _register(metric):
+    _metrics[metric.name] = metric
+    return metric
+
+
+def counter(name, doc):
+    return _metrics.get(name) or _register(Counter(name, doc))
+
+
+def histogram(name, doc, buckets=BUCKETS):
+    return _metrics.get(name) or _register(Histogram(name, doc, buckets))
+
+
+def add_collector(func):
+    _collectors.append(func)
+    return func
+
+
+handler_seconds = histogram("bot_handler_seconds", "Update handler latency")
+db_seconds = histogram("bot_db_query_seconds", "bot_db function run time, in the executor thread")
+db_wait_seconds = histogram("bot_db_executor_wait_seconds", "Time a bot_db call waited for an executor thread")
+report_phase_seconds = histogram("bot_report_phase_seconds", "Report generation time per phase")
+reports_total = counter("bot_reports_total", "Reports requested, by how they were served")
+
+
+def log_event(event, **fields):
+    """One JSON line per event on the ``metrics`` logger."""
+    if METRICS_LOG:
+        log.info(json.dumps({"event": event, "ts": round(time.time(), 3), **fields}, ensure_ascii=False, default=str))
+
+
+def render():
+    lines = []
+    with _lock:
+        for metric in _metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.doc}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_labels_text(labels)} {value}")
+    gauges = {}
+    for collect in _collectors:
+        try:
+            gauges.update(collect())
+        except Exception as e:
+            log.warning("metrics collector %s failed: %s", getattr(collect, "__name__", collect), e)
+    seen = set()
+    for (name, labels), value in sorted(gauges.items()):
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name}{_labels_text(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+async def start_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Serve /metrics; returns the aiohttp runner, or None when disabled."""
+    if not port:
+        return None
+    from aiohttp import web
+
+    async def handle(_request):
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port + port_offset).start()
+    return runner
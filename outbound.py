@@ -0,0 +1,157 @@
+"""Outbound Telegram requests, paced to the Bot API limits.
+
+Every request aimed at a chat waits for a token from that chat's bucket
+(new messages only) and then from the global bucket; global tokens go to
+interactive replies before bulk deliveries. A 429 pauses the chat for
+the ``retry_after`` Telegram asked for and the request is retried.
+
+Bulk senders mark themselves with ``with bulk():`` (or by running in a
+task started inside it); everything else counts as interactive.
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiogram import Bot
+from aiogram.utils.exceptions import RetryAfter
+
+import metrics
+from throttling import TokenBucket
+from settings import (
+    SEND_GLOBAL_RATE,
+    SEND_GLOBAL_BURST,
+    SEND_CHAT_RATE,
+    SEND_CHAT_BURST,
+    SEND_MAX_RETRIES,
+)
+
+
+INTERACTIVE = 0
+BULK = 1
+
+send_priority = ContextVar("send_priority", default=INTERACTIVE)
+
+send_seconds = metrics.histogram("bot_send_seconds", "Bot API request time, including time spent queued")
+send_wait_seconds = metrics.histogram("bot_send_wait_seconds", "Time a Bot API request waited for rate limit tokens")
+retry_after_total = metrics.counter("bot_send_retry_after_total", "429 responses from the Bot API")
+
+
+@contextmanager
+def bulk():
+    token = send_priority.set(BULK)
+    try:
+        yield
+    finally:
+        send_priority.reset(token)
+
+
+class SendScheduler:
+    def __init__(self, global_rate=SEND_GLOBAL_RATE, global_burst=SEND_GLOBAL_BURST,
+                 chat_rate=SEND_CHAT_RATE, chat_burst=SEND_CHAT_BURST):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chats = {}     # chat_id -> TokenBucket
+        self._waiting = []   # heap of (priority, seq, future)
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._task = None
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                now = time.monotonic()
+                for key, b in list(self._chats.items()):
+                    b.refill(now)
+                    if b.tokens >= b.burst:
+                        del self._chats[key]
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def acquire(self, chat_id, priority, counts_for_chat=True):
+        if counts_for_chat:
+            # only this chat waits for its own bucket
+            bucket = self._chat_bucket(chat_id)
+            while True:
+                wait = bucket.take(time.monotonic())
+                if not wait:
+                    break
+                await asyncio.sleep(wait)
+
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._seq), future))
+        self._wakeup.set()
+        await future
+
+    def pause_chat(self, chat_id, seconds):
+        bucket = self._chat_bucket(chat_id)
+        bucket.refill(time.monotonic())
+        bucket.tokens = min(bucket.tokens, 0) - seconds * bucket.rate
+
+    async def _run(self):
+        while True:
+            while self._waiting and self._waiting[0][-1].done():
+                heapq.heappop(self._waiting)   # the sender was cancelled
+            if not self._waiting:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            wait = self._global.take(time.monotonic())
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+            heapq.heappop(self._waiting)[-1].set_result(None)
+
+    def stats(self):
+        return {"waiting": len(self._waiting), "chats": len(self._chats)}
+
+
+send_scheduler = SendScheduler()
+
+
+def _rewind(files):
+    # the failed attempt already read the uploads to the end
+    for f in (files or {}).values():
+        fileobj = f[-1] if isinstance(f, tuple) else getattr(f, "file", f)
+        if hasattr(fileobj, "seek"):
+            fileobj.seek(0)
+
+
+class ThrottledBot(Bot):
+    async def request(self, method, data=None, files=None, **kwargs):
+        chat_id = (data or {}).get("chat_id")
+        if chat_id is None:
+            # callback answers, getMe, webhook setup: not chat messages
+            return await super().request(method, data, files, **kwargs)
+
+        priority = send_priority.get()
+        labels = {"method": method, "priority": "bulk" if priority == BULK else "interactive"}
+        started = time.perf_counter()
+        attempt = 0
+        while True:
+            queued = time.perf_counter()
+            # new messages use the chat's bucket; edits only the global one,
+            # unless Telegram already asked this chat to slow down
+            counts_for_chat = attempt > 0 or method.startswith(("send", "copy", "forward"))
+            await send_scheduler.acquire(chat_id, priority, counts_for_chat)
+            send_wait_seconds.observe(time.perf_counter() - queued, **labels)
+            try:
+                res = await super().request(method, data, files, **kwargs)
+            except RetryAfter as e:
+                retry_after_total.inc(method=method)
+                attempt += 1
+                if attempt > SEND_MAX_RETRIES:
+                    raise
+                # Telegram's retry_after plus a growing margin for repeat offenders
+                send_scheduler.pause_chat(chat_id, e.timeout + 2 ** (attempt - 1) - 1)
+                _rewind(files)
+                continue
+            send_seconds.observe(time.perf_counter() - started, **labels)
+            return res
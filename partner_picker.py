@@ -0,0 +1,121 @@
+import difflib
+import zlib
+
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+import ref_cache
+from keyboards import RESTART_BUTTON, serialize
+
+
+PAGE_SIZE = 20
+LETTERS_PER_ROW = 6
+SEARCH_LIMIT = 10
+WORLD = "весь мир"
+
+
+def _normalize(text):
+    return text.lower().replace("ё", "е").strip()
+
+
+class PartnerIndex:
+    """Letter buckets and a search index over the partner list.
+
+    Callback data refers to partners by position, so it carries a short
+    version of the list it was built from; buttons from an older list are
+    recognised as stale instead of picking the wrong partner.
+    """
+
+    def __init__(self, partners):
+        self.partners = partners
+        self.version = format(zlib.crc32("\n".join(partners).encode("utf-8")), "08x")
+        self._normalized = [_normalize(p) for p in partners]
+        self._by_normalized = {}
+        for i, name in enumerate(self._normalized):
+            self._by_normalized.setdefault(name, i)
+
+        self.buckets = {}   # letter -> [partner positions]
+        for i, name in enumerate(partners):
+            if name == WORLD:
+                continue
+            self.buckets.setdefault(name[:1].upper(), []).append(i)
+        self.letters = sorted(self.buckets)
+        self._markups = {}
+
+    def search(self, text, limit=SEARCH_LIMIT):
+        query = _normalize(text)
+        if not query:
+            return []
+        exact = self._by_normalized.get(query)
+        if exact is not None:
+            return [exact]
+
+        prefix, word_prefix, substring = [], [], []
+        for i, name in enumerate(self._normalized):
+            if name.startswith(query):
+                prefix.append(i)
+            elif any(word.startswith(query) for word in name.split()):
+                word_prefix.append(i)
+            elif query in name:
+                substring.append(i)
+        found = (prefix + word_prefix + substring)[:limit]
+        if found:
+            return found
+
+        # typos: fall back to similarity over the whole names
+        close = difflib.get_close_matches(query, self._normalized, n=limit, cutoff=0.6)
+        return [self._by_normalized[name] for name in close]
+
+    def _cached(self, key, build):
+        markup = self._markups.get(key)
+        if markup is None:
+            markup = self._markups[key] = serialize(build())
+        return markup
+
+    def _pick_button(self, i):
+        return InlineKeyboardButton(self.partners[i], callback_data=f"pp:P:{self.version}:{i}")
+
+    def letters_markup(self):
+        def build():
+            kb = InlineKeyboardMarkup(row_width=LETTERS_PER_ROW)
+            if WORLD in self._by_normalized:
+                kb.row(self._pick_button(self._by_normalized[WORLD]))
+            kb.add(*(
+                InlineKeyboardButton(letter, callback_data=f"pp:B:{self.version}:{n}:0")
+                for n, letter in enumerate(self.letters)
+            ))
+            kb.row(InlineKeyboardButton(RESTART_BUTTON, callback_data="pp:R"))
+            return kb
+        return self._cached("letters", build)
+
+    def bucket_markup(self, letter_no, page):
+        def build():
+            positions = self.buckets[self.letters[letter_no]]
+            pages = (len(positions) + PAGE_SIZE - 1) // PAGE_SIZE
+            kb = InlineKeyboardMarkup(row_width=2)
+            kb.add(*(self._pick_button(i) for i in positions[page * PAGE_SIZE:(page + 1) * PAGE_SIZE]))
+            nav = []
+            if page > 0:
+                nav.append(InlineKeyboardButton("◀", callback_data=f"pp:B:{self.version}:{letter_no}:{page - 1}"))
+            nav.append(InlineKeyboardButton("К буквам", callback_data=f"pp:L:{self.version}"))
+            if page + 1 < pages:
+                nav.append(InlineKeyboardButton("▶", callback_data=f"pp:B:{self.version}:{letter_no}:{page + 1}"))
+            kb.row(*nav)
+            return kb
+        return self._cached(("bucket", letter_no, page), build)
+
+    def results_markup(self, positions):
+        kb = InlineKeyboardMarkup(row_width=1)
+        kb.add(*(self._pick_button(i) for i in positions))
+        kb.row(InlineKeyboardButton("К буквам", callback_data=f"pp:L:{self.version}"))
+        return serialize(kb)
+
+
+_index = None
+
+
+async def get_partner_index():
+    global _index
+    partners = await ref_cache.get_partners()
+    if _index is None or _index.partners is not partners:
+        _index = PartnerIndex(partners)
+    return _index
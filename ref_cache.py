@@ -0,0 +1,132 @@
+import asyncio
+import time
+
+import bot_db_async
+import cache_events
+from settings import REF_CACHE_TTL, DATA_VERSION_TTL
+from tnved_index import TnvedIndex
+
+
+class RefCache:
+    def __init__(self, ttl=REF_CACHE_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # bumped on every reload so dependants can tell the data changed
+        self.version = 0
+        self._entries = {}
+        self._locks = {}
+
+    def _fresh(self, key):
+        entry = self._entries.get(key)
+        if entry and entry[1] > time.monotonic():
+            return entry
+        return None
+
+    async def get(self, key, loader, ttl=None):
+        entry = self._fresh(key)
+        if entry:
+            self.hits += 1
+            return entry[0]
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            # another coroutine may have reloaded it while we waited
+            entry = self._fresh(key)
+            if entry:
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            value = await loader()
+            self._entries[key] = (value, time.monotonic() + (ttl or self.ttl))
+            self.version += 1
+            return value
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "version": self.version,
+        }
+
+
+ref_cache = RefCache()
+# reloads requested in any bot process (/refresh_cache, /exclusions) reach all of them
+cache_events.subscribe("ref", ref_cache.invalidate)
+
+
+async def _load_partners():
+    partners = await bot_db_async.get_partners()
+    return partners, frozenset(partners)
+
+async def _load_categories():
+    categories = await bot_db_async.get_categories()
+    return categories, frozenset(categories)
+
+async def _load_subcategories():
+    subcategories = await bot_db_async.get_all_subcategories()
+    return {parent: (names, frozenset(names)) for parent, names in subcategories.items()}
+
+async def _load_tnved_index():
+    return TnvedIndex(await bot_db_async.get_tnved_codes())
+
+
+async def get_partners():
+    return (await ref_cache.get("partners", _load_partners))[0]
+
+async def is_partner(name):
+    return name in (await ref_cache.get("partners", _load_partners))[1]
+
+async def get_years():
+    return await ref_cache.get("years", bot_db_async.get_years)
+
+async def get_categories():
+    return (await ref_cache.get("categories", _load_categories))[0]
+
+async def is_category(name):
+    return name in (await ref_cache.get("categories", _load_categories))[1]
+
+async def get_subcategories(parent_name):
+    subcategories = await ref_cache.get("subcategories", _load_subcategories)
+    return subcategories.get(parent_name, ([], frozenset()))[0]
+
+async def is_subcategory(parent_name, name):
+    subcategories = await ref_cache.get("subcategories", _load_subcategories)
+    return name in subcategories.get(parent_name, ([], frozenset()))[1]
+
+async def get_tnved_index():
+    return await ref_cache.get("tnved_index", _load_tnved_index)
+
+async def tnved_exists(code):
+    return code in await get_tnved_index()
+
+async def suggest_tnved(text, limit=10):
+    return (await get_tnved_index()).suggest(text, limit)
+
+async def get_data_version():
+    return await ref_cache.get("data_version", bot_db_async.get_data_version, ttl=DATA_VERSION_TTL)
+
+
+async def warm_up():
+    await asyncio.gather(
+        get_partners(),
+        get_years(),
+        get_categories(),
+        get_subcategories(None),
+        get_tnved_index(),
+        get_data_version(),
+    )
+
+async def refresh():
+    await cache_events.publish("ref")
+    await warm_up()
+    return ref_cache.stats()
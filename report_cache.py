@@ -0,0 +1,122 @@
+import asyncio
+import hashlib
+import json
+import os
+
+from settings import REPORT_CACHE_DIR, REPORT_CACHE_MAX_BYTES
+
+
+def cache_key(kwargs, data_version):
+    payload = json.dumps({"data_version": data_version, "kwargs": kwargs}, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ReportCache:
+    """Rendered .docx files on local disk, evicted least-recently-used first.
+
+    Each entry is ``<key>.json`` (status, filenames, data version) plus
+    ``<key>.docx`` for reports that have data. A hit bumps the mtime, which
+    is what the eviction order is based on.
+    """
+
+    def __init__(self, directory=REPORT_CACHE_DIR, max_bytes=REPORT_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._data_version = None
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + ".json", base + ".docx"
+
+    def _read(self, key):
+        meta_path, doc_path = self._paths(key)
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                res = json.load(f)
+            if res["status"] != 'no_data':
+                with open(doc_path, "rb") as f:
+                    res["content"] = f.read()
+                os.utime(doc_path)
+            os.utime(meta_path)
+        except (OSError, ValueError, KeyError):
+            return None
+        return res
+
+    def _write(self, key, data_version, res):
+        os.makedirs(self.directory, exist_ok=True)
+        meta_path, doc_path = self._paths(key)
+        meta = {k: v for k, v in res.items() if k != "content"}
+        meta["data_version"] = data_version
+        if "content" in res:
+            with open(doc_path + ".tmp", "wb") as f:
+                f.write(res["content"])
+            os.replace(doc_path + ".tmp", doc_path)
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(meta_path + ".tmp", meta_path)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith((".json", ".docx")):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def _purge_other_versions(self, data_version):
+        if not os.path.isdir(self.directory):
+            return
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                with open(entry.path, encoding="utf-8") as f:
+                    version = json.load(f).get("data_version")
+            except (OSError, ValueError):
+                version = None
+            if version != data_version:
+                for path in self._paths(entry.name[:-len(".json")]):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+    async def get(self, key, data_version):
+        if data_version != self._data_version:
+            # the `data` table changed: nothing on disk can be served anymore
+            await asyncio.to_thread(self._purge_other_versions, data_version)
+            self._data_version = data_version
+
+        res = await asyncio.to_thread(self._read, key)
+        if res is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return res
+
+    async def put(self, key, data_version, res):
+        await asyncio.to_thread(self._write, key, data_version, res)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+
+report_cache = ReportCache()
@@ -0,0 +1,181 @@
+"""Report jobs persisted in the users DB (report_jobs table).
+
+Every confirmed report becomes a job row before anything is rendered.
+In "inline" mode the handler runs its job straight away; in "queue" mode
+it only enqueues it. Either way, consumers (the bot itself and any
+``report_worker.py`` processes) claim queued jobs and jobs whose owner
+stopped sending heartbeats, so a restart or crash never loses a request.
+"""
+import asyncio
+import os
+import socket
+import time
+
+import bot_db_async
+import metrics
+from history_writer import add_download_history
+from outbound import bulk
+from report_pool import ReportQueueFull
+from report_scheduler import UserLimitReached
+from reports import get_report, send_report_document
+from settings import (
+    REPORT_JOB_CONSUMERS,
+    REPORT_JOB_POLL_INTERVAL,
+    REPORT_JOB_HEARTBEAT,
+    REPORT_JOB_STALE_AFTER,
+    REPORT_JOB_MAX_ATTEMPTS,
+    REPORT_JOB_KEEP_DAYS,
+    REPORT_PER_USER_LIMIT,
+)
+
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+_running = set()   # ids of jobs this process is working on
+
+
+class ChatTarget:
+    """The answer()/answer_document() interface of a Message, for a chat
+    the bot is writing to without an incoming update."""
+
+    def __init__(self, bot, chat_id):
+        self.bot = bot
+        self.chat_id = chat_id
+
+    async def answer(self, text, **kwargs):
+        return await self.bot.send_message(self.chat_id, text, **kwargs)
+
+    async def answer_document(self, document, **kwargs):
+        return await self.bot.send_document(self.chat_id, document, **kwargs)
+
+
+async def create_job(telegram_id, chat_id, priority, params, run_here):
+    job_id = await bot_db_async.create_report_job(
+        telegram_id, chat_id, priority, params,
+        worker=WORKER_ID if run_here else None,
+        per_user_limit=REPORT_PER_USER_LIMIT,
+    )
+    if job_id is None:
+        raise UserLimitReached()
+    if run_here:
+        _running.add(job_id)
+    return job_id
+
+
+async def run_job(job_id, telegram_id, priority, params, target, on_progress=None):
+    _running.add(job_id)
+    try:
+        await _run_job(job_id, telegram_id, priority, params, target, on_progress)
+    finally:
+        _running.discard(job_id)
+
+
+async def _run_job(job_id, telegram_id, priority, params, target, on_progress):
+    report_kwargs = params["kwargs"]
+    started = time.perf_counter()
+    requester = {"telegram_id": telegram_id, "priority": priority, "on_progress": on_progress}
+    try:
+        res = await get_report(requester=requester, **report_kwargs)
+    except Exception as e:
+        await _job_failed(job_id, telegram_id, params, target, e)
+        return
+
+    await bot_db_async.update_report_job(job_id, 'done', result_key=res["cache_key"])
+    if res["status"] != 'no_data':
+        try:
+            await send_report_document(target, res, report_kwargs, requester)
+        except (UserLimitReached, ReportQueueFull) as e:
+            # a stale file_id sent the report back for rendering
+            await _job_failed(job_id, telegram_id, params, target, e)
+            return
+        await target.answer(f"Ваш документ {res['filename']} готов. Чтобы начать заново, нажмите /start")
+        await add_download_history(telegram_id, params["hist_txt"], params["year"])
+    else:
+        await target.answer("По выбранным фильтрам нет данных. Чтобы начать заново, нажмите /start")
+    await bot_db_async.update_report_job(job_id, 'delivered')
+    elapsed = time.perf_counter() - started
+    metrics.report_phase_seconds.observe(elapsed, phase="total")
+    metrics.log_event(
+        "report_delivered", job_id=job_id, telegram_id=telegram_id, report=params["hist_txt"],
+        status=res["status"], seconds=round(elapsed, 3),
+    )
+
+
+async def _job_failed(job_id, telegram_id, params, target, e):
+    if isinstance(e, UserLimitReached):
+        await bot_db_async.update_report_job(job_id, 'failed', error="user limit")
+        await target.answer("У вас уже генерируются другие справки. Дождитесь их готовности и повторите попытку. Чтобы начать заново, нажмите /start")
+        return
+    if isinstance(e, ReportQueueFull):
+        await bot_db_async.update_report_job(job_id, 'failed', error="queue full")
+        await target.answer("Сейчас генерируется слишком много справок. Пожалуйста, повторите попытку через несколько минут. Чтобы начать заново, нажмите /start")
+        return
+    metrics.log_event("report_failed", job_id=job_id, telegram_id=telegram_id, error=str(e))
+    await bot_db_async.update_report_job(job_id, 'failed', error=str(e))
+    await target.answer("Произошла ошибка при генерации файла. Чтобы начать заново, нажмите /start")
+    if params.get("role") == 'admin':
+        await target.answer(f"!!! oh no, error occured:\n{e}")
+
+
+async def _run_claimed(bot, row):
+    job_id, telegram_id, chat_id, priority, params, attempts, _ = row
+    target = ChatTarget(bot, chat_id)
+    # nobody is waiting on this chat right now: a queued or recovered job
+    with bulk():
+        if attempts > REPORT_JOB_MAX_ATTEMPTS:
+            await bot_db_async.update_report_job(job_id, 'failed', error="too many attempts")
+            await target.answer("Не удалось сгенерировать справку. Чтобы начать заново, нажмите /start")
+            return
+        await run_job(job_id, telegram_id, priority, params, target)
+
+
+async def _heartbeat_loop():
+    while True:
+        await asyncio.sleep(REPORT_JOB_HEARTBEAT)
+        try:
+            if _running:
+                await bot_db_async.heartbeat_report_jobs(list(_running))
+        except Exception as e:
+            print(f"report_jobs heartbeat failed: {e}")
+
+
+async def consume(bot, consumers=None):
+    """Claim and run jobs until cancelled, at most ``consumers`` at a time
+    (REPORT_JOB_CONSUMERS by default)."""
+    consumers = consumers or REPORT_JOB_CONSUMERS
+    heartbeat = asyncio.ensure_future(_heartbeat_loop())
+    slots = asyncio.Semaphore(consumers)
+    tasks = set()
+    purged_at = 0.0
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            await slots.acquire()
+            try:
+                if loop.time() - purged_at > 3600:
+                    purged_at = loop.time()
+                    await bot_db_async.purge_report_jobs(REPORT_JOB_KEEP_DAYS)
+                row = await bot_db_async.claim_report_job(WORKER_ID, REPORT_JOB_STALE_AFTER)
+            except Exception as e:
+                print(f"report_jobs claim failed: {e}")
+                row = None
+            if row is None:
+                slots.release()
+                await asyncio.sleep(REPORT_JOB_POLL_INTERVAL)
+                continue
+
+            task = asyncio.ensure_future(_run_claimed(bot, row))
+            tasks.add(task)
+
+            def done(t):
+                tasks.discard(t)
+                slots.release()
+                if not t.cancelled() and t.exception() is not None:
+                    print(f"report job failed: {t.exception()}")
+            task.add_done_callback(done)
+    finally:
+        heartbeat.cancel()
+        # jobs interrupted here keep their rows and are picked up again
+        # by another consumer once their heartbeat goes stale
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,145 @@
+import asyncio
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+import metrics
+from config import REPORT_MODULE_PATH
+from settings import REPORT_WORKERS, REPORT_QUEUE_SIZE, REPORT_TIMEOUT
+
+
+recycled_total = metrics.counter("bot_report_pool_recycled_total", "Report worker pools killed because a render hung")
+
+class ReportQueueFull(Exception):
+    pass
+
+
+class ReportTimeout(Exception):
+    pass
+
+
+def _init_worker(module_path):
+    sys.path.insert(0, module_path)
+
+
+def _render_report(kwargs):
+    # Runs inside a worker process: the docx object is not picklable,
+    # so it is serialized here and only bytes travel back to the bot.
+    # The generator queries the trade DB and builds the document in one
+    # call, so "generate" covers both; "serialize" is the .docx encoding.
+    from document_gen.generator import generate_trade_document # type: ignore
+
+    started = time.perf_counter()
+    res = generate_trade_document(**kwargs)
+    generated = time.perf_counter()
+    if res["status"] == 'no_data':
+        return {"status": res["status"], "timings": {"generate": generated - started}}
+
+    buf = BytesIO()
+    res["doc"].save(buf)
+    return {
+        "status": res["status"],
+        "filename": res["filename"],
+        "short_filename": res["short_filename"],
+        "content": buf.getvalue(),
+        "timings": {"generate": generated - started, "serialize": time.perf_counter() - generated},
+    }
+
+
+class ReportPool:
+    def __init__(self, workers=REPORT_WORKERS, queue_size=REPORT_QUEUE_SIZE, timeout=REPORT_TIMEOUT):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._executor = None
+        self._in_flight = 0
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def start(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=_init_worker,
+                initargs=(REPORT_MODULE_PATH,),
+            )
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+
+    def recycle(self, executor=None):
+        """Kill the worker processes and start over with a fresh pool.
+
+        A render that hangs (e.g. on a DB lock) cannot be cancelled inside
+        its process. Jobs the other workers were running fail with
+        BrokenProcessPool and are resubmitted by ``submit``. With
+        ``executor``, only that pool is killed, not one started since.
+        """
+        if self._executor is None or executor not in (None, self._executor):
+            return
+        executor, self._executor = self._executor, None
+        recycled_total.inc()
+        # ProcessPoolExecutor has no public way to kill its workers
+        for process in list((executor._processes or {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False)
+
+    def _release(self, _future):
+        self._in_flight -= 1
+
+    def _submit(self, kwargs):
+        self.start()
+        try:
+            future = self._executor.submit(_render_report, kwargs)
+        except BrokenProcessPool:
+            # a worker died (e.g. OOM-killed) - start over with a fresh pool
+            self.shutdown(wait=False)
+            self.start()
+            future = self._executor.submit(_render_report, kwargs)
+
+        # The slot is held until the worker is really done, so a job that
+        # timed out while running still counts against the queue bound.
+        loop = asyncio.get_running_loop()
+        self._in_flight += 1
+        future.add_done_callback(lambda f: loop.call_soon_threadsafe(self._release, f))
+        return self._executor, future
+
+    async def submit(self, timeout=None, **kwargs):
+        if self._in_flight >= self.workers + self.queue_size:
+            raise ReportQueueFull()
+        timeout = timeout or self.timeout
+        deadline = time.monotonic() + timeout
+        submitted = time.perf_counter()
+        for attempt in range(3):
+            executor, future = self._submit(kwargs)
+            try:
+                res = await asyncio.wait_for(asyncio.wrap_future(future), max(0.0, deadline - time.monotonic()))
+                break
+            except asyncio.TimeoutError:
+                # still queued: wait_for has cancelled it; running: only
+                # killing its process stops it and frees the worker
+                if not future.cancelled():
+                    self.recycle(executor)
+                raise ReportTimeout(f"Генерация справки заняла больше {timeout} секунд.")
+            except BrokenProcessPool:
+                # the pool was recycled under this job (another job hung)
+                # or a worker died; try again on a fresh pool, but a job
+                # that keeps killing its worker gives up
+                if attempt == 2:
+                    raise
+        timings = res.pop("timings", {})
+        for phase, seconds in timings.items():
+            metrics.report_phase_seconds.observe(seconds, phase=phase)
+        # whatever the worker did not account for: pickling and waiting for a free process
+        metrics.report_phase_seconds.observe(
+            max(0.0, time.perf_counter() - submitted - sum(timings.values())), phase="pool_overhead")
+        return res
+
+
+report_pool = ReportPool()
@@ -0,0 +1,127 @@
+import asyncio
+import heapq
+import itertools
+from collections import Counter
+
+from report_pool import ReportQueueFull
+from settings import REPORT_MAX_CONCURRENCY, REPORT_PER_USER_LIMIT, REPORT_SCHEDULER_QUEUE
+
+
+PRIORITY_ADMIN = 0
+PRIORITY_USER = 1
+PRIORITY_BATCH = 2
+
+
+class UserLimitReached(Exception):
+    pass
+
+
+class _Job:
+    def __init__(self, telegram_id, func, on_progress):
+        self.telegram_id = telegram_id
+        self.func = func
+        self.on_progress = on_progress
+        self.position = None
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class ReportScheduler:
+    """Runs report jobs with a global concurrency cap and a per-user limit.
+
+    Waiting jobs are ordered by (priority, user's turn, arrival): admins go
+    first, and a user with several queued jobs only gets their second job
+    after everyone else's first one, so one user's burst cannot starve the
+    rest. ``on_progress(position)`` is called whenever a job's place in
+    the queue changes; position 0 means the job has started.
+    """
+
+    def __init__(self, max_concurrency=REPORT_MAX_CONCURRENCY, per_user_limit=REPORT_PER_USER_LIMIT, max_queue=REPORT_SCHEDULER_QUEUE):
+        self.max_concurrency = max_concurrency
+        self.per_user_limit = per_user_limit
+        self.max_queue = max_queue
+        self.rejected = 0
+        self._heap = []
+        self._seq = itertools.count()
+        self._running = 0
+        self._per_user = Counter()   # queued + running jobs per user
+
+    @property
+    def queued(self):
+        return len(self._heap)
+
+    @property
+    def running(self):
+        return self._running
+
+    async def run(self, telegram_id, func, priority=PRIORITY_USER, on_progress=None, user_limit=None):
+        return await self.schedule(telegram_id, func, priority, on_progress, user_limit).future
+
+    def schedule(self, telegram_id, func, priority=PRIORITY_USER, on_progress=None, user_limit=None):
+        """Queue ``func`` and return its job; await ``job.future`` for the result."""
+        if self._per_user[telegram_id] >= (user_limit or self.per_user_limit):
+            self.rejected += 1
+            raise UserLimitReached()
+        if len(self._heap) >= self.max_queue:
+            self.rejected += 1
+            raise ReportQueueFull()
+
+        job = _Job(telegram_id, func, on_progress)
+        turn = self._per_user[telegram_id]
+        self._per_user[telegram_id] += 1
+        heapq.heappush(self._heap, (priority, turn, next(self._seq), job))
+        self._dispatch()
+        self._report_positions()
+        return job
+
+    def promote(self, job, priority):
+        """Move a still-queued job up to ``priority`` (never down)."""
+        for i, entry in enumerate(self._heap):
+            if entry[-1] is job:
+                if priority < entry[0]:
+                    self._heap[i] = (priority, *entry[1:])
+                    heapq.heapify(self._heap)
+                    self._report_positions()
+                return
+
+    def _dispatch(self):
+        while self._running < self.max_concurrency and self._heap:
+            job = heapq.heappop(self._heap)[-1]
+            self._running += 1
+            self._notify(job, 0)
+            task = asyncio.ensure_future(job.func())
+            task.add_done_callback(lambda t, job=job: self._finished(job, t))
+
+    def _finished(self, job, task):
+        self._running -= 1
+        self._per_user[job.telegram_id] -= 1
+        if not self._per_user[job.telegram_id]:
+            del self._per_user[job.telegram_id]
+        if not job.future.done():
+            if task.cancelled():
+                job.future.cancel()
+            elif task.exception() is not None:
+                job.future.set_exception(task.exception())
+            else:
+                job.future.set_result(task.result())
+        self._dispatch()
+        self._report_positions()
+
+    def _report_positions(self):
+        for position, entry in enumerate(sorted(self._heap), start=1):
+            self._notify(entry[-1], position)
+
+    def _notify(self, job, position):
+        if job.on_progress is None or job.position == position:
+            return
+        job.position = position
+        asyncio.ensure_future(job.on_progress(position))
+
+    def stats(self):
+        return {
+            "running": self._running,
+            "queued": len(self._heap),
+            "rejected": self.rejected,
+        }
+
+
+report_scheduler = ReportScheduler()
@@ -0,0 +1,55 @@
+"""Standalone report worker: renders and delivers jobs from the report_jobs
+table, next to (or instead of) the bot process.
+
+    python report_worker.py
+"""
+import asyncio
+import logging
+import signal
+
+from aiogram import Bot
+
+import bot_db_async
+import cache_events
+import ref_cache
+import exclusions
+import report_jobs
+from bot_db import setup_users_tables, trade_pool, users_pool, close_pools
+from config import API_TOKEN
+from history_writer import history_writer
+from outbound import ThrottledBot
+from report_pool import report_pool
+
+
+async def main():
+    setup_users_tables()
+    listener = asyncio.ensure_future(cache_events.listen())
+    trade_pool.warm_up()
+    users_pool.warm_up()
+    report_pool.start()
+    await ref_cache.warm_up()
+    await exclusions.get_exclusions()
+
+    bot = ThrottledBot(token=API_TOKEN)
+    Bot.set_current(bot)
+    consumer = asyncio.ensure_future(report_jobs.consume(bot))
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, consumer.cancel)
+    try:
+        await consumer
+    except asyncio.CancelledError:
+        pass
+    finally:
+        listener.cancel()
+        await history_writer.close()
+        report_pool.shutdown()
+        await bot.session.close()
+        bot_db_async.shutdown()
+        close_pools()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
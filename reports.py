@@ -0,0 +1,231 @@
+import asyncio
+import functools
+import time
+from collections import OrderedDict
+from io import BytesIO
+
+from aiogram.utils.exceptions import TypeOfFileMismatch, WrongFileIdentifier, WrongRemoteFileIdSpecified
+
+import bot_db_async
+import metrics
+from ref_cache import get_data_version
+from report_cache import report_cache, cache_key
+from report_pool import report_pool, ReportQueueFull
+from report_scheduler import report_scheduler, PRIORITY_USER, UserLimitReached
+
+
+FILE_ID_MEMORY_SIZE = 1000
+
+# cache_key -> {"status", "filename", "short_filename", "file_id"};
+# a bounded mirror of the report_files table
+_sent_files = OrderedDict()
+
+# cache_key -> _Flight rendering that report right now; identical requests
+# arriving meanwhile await the same task instead of starting their own
+_in_flight = {}
+_coalescing = {"generations": 0, "coalesced": 0}
+
+
+async def _get_sent_file(key):
+    sent = _sent_files.get(key)
+    if sent is not None:
+        _sent_files.move_to_end(key)
+        return sent
+    sent = await bot_db_async.get_report_file(key)
+    if sent is not None:
+        _remember(key, sent)
+    return sent
+
+def _remember(key, sent):
+    _sent_files[key] = sent
+    _sent_files.move_to_end(key)
+    while len(_sent_files) > FILE_ID_MEMORY_SIZE:
+        _sent_files.popitem(last=False)
+
+
+def make_report_kwargs(partner, year, tn_ved=None, subcategory=None, plain=0, exclude_raw=""):
+    """Generator arguments for a справка plus its download_history text."""
+    long_report=0
+    if tn_ved:
+        subcategory = None
+        long_report=1
+
+    report_kwargs = dict(
+        region="Республика Казахстан",
+        country_or_group=partner,
+        start_year=None,
+        end_year=year,
+        digit=4,
+        category=subcategory,
+        text_size=7,
+        table_size=25,
+        country_table_size=15,
+        tn_ved=tn_ved,
+        month_range_raw="",
+        exclude_raw=exclude_raw,
+        long_report=long_report,
+        plain=plain,
+        include_regions=0,
+        change_color=1,
+    )
+
+    no_tn_ved = "None"
+    no_subcategory = "None"
+    no_plain = "None"
+    if tn_ved:
+        no_tn_ved = tn_ved
+    if subcategory:
+        no_subcategory = subcategory
+    if plain !=0:
+        no_plain = "Самолётик"
+    hist_txt = partner +' '+ no_tn_ved +' '+ no_subcategory +' '+ no_plain
+    return report_kwargs, hist_txt
+
+
+class _Flight:
+    """One render shared by every request for the same report.
+
+    The job runs at the best priority among its waiters and queue
+    positions go to all of them; the scheduling limits (per-user limit,
+    queue bound) are those of the requester that started it.
+    """
+
+    def __init__(self, requester):
+        self.priority = requester.get("priority", PRIORITY_USER)
+        self.job = None
+        self.position = None
+        self._listeners = []
+        self.task = None
+        self.join(requester)
+
+    def join(self, requester):
+        on_progress = requester.get("on_progress")
+        if on_progress is not None:
+            self._listeners.append(on_progress)
+        before = self.job.position if self.job is not None else None
+        priority = requester.get("priority", PRIORITY_USER)
+        if priority < self.priority:
+            self.priority = priority
+            if self.job is not None:
+                report_scheduler.promote(self.job, priority)
+        # a promotion that moved the job is fanned out to every listener,
+        # this one included; otherwise tell the newcomer where the job is
+        if on_progress is not None and before is not None and self.job.position == before:
+            asyncio.ensure_future(on_progress(before))
+
+    def leave(self, requester):
+        on_progress = requester.get("on_progress")
+        if on_progress in self._listeners:
+            self._listeners.remove(on_progress)
+
+    async def on_progress(self, position):
+        self.position = position
+        await asyncio.gather(*(listener(position) for listener in list(self._listeners)), return_exceptions=True)
+
+
+def _landed(key, flight, _task):
+    if _in_flight.get(key) is flight:
+        del _in_flight[key]
+
+
+async def get_report(use_file_id=True, requester=None, **kwargs):
+    """``requester``: {"telegram_id", "priority", "on_progress", "user_limit"}
+    used to schedule the render if the report has to be generated."""
+    data_version = await get_data_version()
+    key = cache_key(kwargs, data_version)
+    meta = {"cache_key": key, "data_version": data_version}
+
+    if use_file_id:
+        sent = await _get_sent_file(key)
+        if sent is not None:
+            metrics.reports_total.inc(source="file_id")
+            return {**sent, **meta}
+
+    requester = requester or {}
+    while True:
+        flight = _in_flight.get(key)
+        started_here = flight is None
+        if started_here:
+            flight = _in_flight[key] = _Flight(requester)
+            flight.task = asyncio.ensure_future(_build(key, data_version, kwargs, requester, flight))
+            flight.task.add_done_callback(functools.partial(_landed, key, flight))
+        else:
+            flight.join(requester)
+            _coalescing["coalesced"] += 1
+            metrics.reports_total.inc(source="coalesced")
+        try:
+            # shielded: one user cancelling must not cancel the job for the others
+            res = await asyncio.shield(flight.task)
+        except (UserLimitReached, ReportQueueFull):
+            if started_here:
+                raise
+            # the limits of whoever started the render turned it down - try
+            # again under this request's own limits
+            _landed(key, flight, None)
+            continue
+        finally:
+            flight.leave(requester)
+        return {**res, **meta}
+
+
+async def _build(key, data_version, kwargs, requester, flight):
+    res = await report_cache.get(key, data_version)
+    if res is not None:
+        metrics.reports_total.inc(source="disk_cache")
+    else:
+        queued = time.perf_counter()
+
+        async def render():
+            metrics.report_phase_seconds.observe(time.perf_counter() - queued, phase="queue")
+            return await report_pool.submit(**kwargs)
+
+        flight.job = report_scheduler.schedule(
+            requester.get("telegram_id"),
+            render,
+            priority=flight.priority,
+            on_progress=flight.on_progress,
+            user_limit=requester.get("user_limit"),
+        )
+        res = await flight.job.future
+        _coalescing["generations"] += 1
+        metrics.reports_total.inc(source="generated")
+        await report_cache.put(key, data_version, res)
+    return res
+
+
+def get_report_stats():
+    return {
+        "rendering": len(_in_flight),
+        "pool_in_flight": report_pool.in_flight,
+        **{f"scheduler_{k}": v for k, v in report_scheduler.stats().items()},
+        **_coalescing,
+        **{f"disk_cache_{k}": v for k, v in report_cache.stats().items()},
+    }
+
+
+async def send_report_document(target, res, kwargs, requester=None):
+    """Send the report's .docx, by Telegram file_id when it was uploaded before.
+
+    ``requester`` is the one ``res`` was fetched for; it is used again when
+    the file_id turns out to be stale and the report has to be rebuilt.
+    """
+    if res.get("file_id"):
+        try:
+            return await target.answer_document(res["file_id"])
+        except (WrongFileIdentifier, WrongRemoteFileIdSpecified, TypeOfFileMismatch):
+            # file_id no longer valid (e.g. the bot token changed) - upload again
+            _sent_files.pop(res["cache_key"], None)
+            await bot_db_async.delete_report_file(res["cache_key"])
+            res = await get_report(use_file_id=False, requester=requester, **kwargs)
+
+    with metrics.report_phase_seconds.time(phase="upload"):
+        sent_msg = await target.answer_document((res["short_filename"], BytesIO(res["content"])))
+    sent = {
+        "status": res["status"],
+        "filename": res["filename"],
+        "short_filename": res["short_filename"],
+        "file_id": sent_msg.document.file_id,
+    }
+    _remember(res["cache_key"], sent)
+    await bot_db_async.save_report_file(res["cache_key"], res["data_version"], **sent)
+    return sent_msg
@@ -0,0 +1,87 @@
+import os
+import config
+
+
+REPORT_WORKERS = getattr(config, "REPORT_WORKERS", os.cpu_count() or 2)
+REPORT_QUEUE_SIZE = getattr(config, "REPORT_QUEUE_SIZE", 20)
+REPORT_TIMEOUT = getattr(config, "REPORT_TIMEOUT", 600)
+
+DB_POOL_MIN_SIZE = getattr(config, "DB_POOL_MIN_SIZE", 1)
+DB_POOL_MAX_SIZE = getattr(config, "DB_POOL_MAX_SIZE", 10)
+DB_POOL_MAX_USES = getattr(config, "DB_POOL_MAX_USES", 1000)
+DB_POOL_BORROW_TIMEOUT = getattr(config, "DB_POOL_BORROW_TIMEOUT", 10)
+DB_POOL_HEALTH_CHECK_AFTER = getattr(config, "DB_POOL_HEALTH_CHECK_AFTER", 30)
+
+DB_EXECUTOR_WORKERS = getattr(config, "DB_EXECUTOR_WORKERS", 2 * DB_POOL_MAX_SIZE)
+
+REF_CACHE_TTL = getattr(config, "REF_CACHE_TTL", 6 * 60 * 60)
+DATA_VERSION_TTL = getattr(config, "DATA_VERSION_TTL", 60)
+
+REPORT_CACHE_DIR = getattr(config, "REPORT_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "report_cache"))
+REPORT_CACHE_MAX_BYTES = getattr(config, "REPORT_CACHE_MAX_BYTES", 2 * 1024 ** 3)
+
+FSM_STORAGE = getattr(config, "FSM_STORAGE", "postgres")
+FSM_FLUSH_INTERVAL = getattr(config, "FSM_FLUSH_INTERVAL", 1.0)
+FSM_TTL = getattr(config, "FSM_TTL", 24 * 60 * 60)
+FSM_CACHE_SIZE = getattr(config, "FSM_CACHE_SIZE", 10000)
+
+BOT_MODE = getattr(config, "BOT_MODE", "polling")
+WEBHOOK_HOST = getattr(config, "WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = getattr(config, "WEBHOOK_PORT", 8080)
+WEBHOOK_PATH = getattr(config, "WEBHOOK_PATH", "/webhook")
+WEBHOOK_URL = getattr(config, "WEBHOOK_URL", None)
+WEBHOOK_SECRET = getattr(config, "WEBHOOK_SECRET", None)
+WEBHOOK_WORKERS = getattr(config, "WEBHOOK_WORKERS", os.cpu_count() or 2)
+WEBHOOK_QUEUE_SIZE = getattr(config, "WEBHOOK_QUEUE_SIZE", 1000)
+
+HISTORY_BATCH_SIZE = getattr(config, "HISTORY_BATCH_SIZE", 5000)
+HISTORY_SPOOL_MAX_BYTES = getattr(config, "HISTORY_SPOOL_MAX_BYTES", 16 * 1024 ** 2)
+HISTORY_PARTITIONING = getattr(config, "HISTORY_PARTITIONING", False)
+HISTORY_PARTITIONS_AHEAD = getattr(config, "HISTORY_PARTITIONS_AHEAD", 3)
+HISTORY_PARTITIONS_CHECK_INTERVAL = getattr(config, "HISTORY_PARTITIONS_CHECK_INTERVAL", 24 * 3600)
+
+HISTORY_FLUSH_SIZE = getattr(config, "HISTORY_FLUSH_SIZE", 100)
+HISTORY_FLUSH_INTERVAL = getattr(config, "HISTORY_FLUSH_INTERVAL", 5.0)
+HISTORY_BUFFER_MAX = getattr(config, "HISTORY_BUFFER_MAX", 10000)
+
+# data_year_summary in the trade DB (triggers on `data`); the bot's
+# DB user needs CREATE and TRIGGER rights there
+TRADE_AGGREGATES = getattr(config, "TRADE_AGGREGATES", False)
+
+AUTH_CACHE_TTL = getattr(config, "AUTH_CACHE_TTL", 300)
+
+REPORT_MAX_CONCURRENCY = getattr(config, "REPORT_MAX_CONCURRENCY", REPORT_WORKERS)
+REPORT_PER_USER_LIMIT = getattr(config, "REPORT_PER_USER_LIMIT", 2)
+REPORT_SCHEDULER_QUEUE = getattr(config, "REPORT_SCHEDULER_QUEUE", 50)
+
+REPORT_JOBS_MODE = getattr(config, "REPORT_JOBS_MODE", "inline")
+REPORT_JOB_CONSUMERS = getattr(config, "REPORT_JOB_CONSUMERS", REPORT_MAX_CONCURRENCY)
+REPORT_JOB_POLL_INTERVAL = getattr(config, "REPORT_JOB_POLL_INTERVAL", 1.0)
+REPORT_JOB_HEARTBEAT = getattr(config, "REPORT_JOB_HEARTBEAT", 30)
+REPORT_JOB_STALE_AFTER = getattr(config, "REPORT_JOB_STALE_AFTER", 120)
+REPORT_JOB_MAX_ATTEMPTS = getattr(config, "REPORT_JOB_MAX_ATTEMPTS", 3)
+REPORT_JOB_KEEP_DAYS = getattr(config, "REPORT_JOB_KEEP_DAYS", 30)
+
+BATCH_MAX_REPORTS = getattr(config, "BATCH_MAX_REPORTS", 500)
+# Telegram bots may upload files of up to 50 MB
+BATCH_ZIP_MAX_BYTES = getattr(config, "BATCH_ZIP_MAX_BYTES", 45 * 1024 ** 2)
+
+# local Prometheus-style endpoint; None disables it. Webhook workers use
+# METRICS_PORT + worker number.
+METRICS_HOST = getattr(config, "METRICS_HOST", "127.0.0.1")
+METRICS_PORT = getattr(config, "METRICS_PORT", 9108)
+METRICS_LOG = getattr(config, "METRICS_LOG", True)
+
+# token buckets per user: refill rate (tokens per second) and burst size
+THROTTLE_NAVIGATION_RATE = getattr(config, "THROTTLE_NAVIGATION_RATE", 2.0)
+THROTTLE_NAVIGATION_BURST = getattr(config, "THROTTLE_NAVIGATION_BURST", 10)
+THROTTLE_GENERATION_RATE = getattr(config, "THROTTLE_GENERATION_RATE", 1 / 20)
+THROTTLE_GENERATION_BURST = getattr(config, "THROTTLE_GENERATION_BURST", 3)
+THROTTLE_DUPLICATE_WINDOW = getattr(config, "THROTTLE_DUPLICATE_WINDOW", 10)
+
+# Bot API limits: about 30 messages/s overall and 1/s per chat with short bursts
+SEND_GLOBAL_RATE = getattr(config, "SEND_GLOBAL_RATE", 30)
+SEND_GLOBAL_BURST = getattr(config, "SEND_GLOBAL_BURST", 30)
+SEND_CHAT_RATE = getattr(config, "SEND_CHAT_RATE", 1)
+SEND_CHAT_BURST = getattr(config, "SEND_CHAT_BURST", 5)
+SEND_MAX_RETRIES = getattr(config, "SEND_MAX_RETRIES", 3)
@@ -0,0 +1,17 @@
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import config  # noqa: F401
+except ImportError:
+    # config.py holds the deployment's token and DSNs and is not part of
+    # the repo; settings.py falls back to defaults for everything else
+    config = types.ModuleType("config")
+    config.API_TOKEN = "0:test"
+    config.DB_CONFIG = {}
+    config.USERS_DB_CONFIG = {}
+    config.REPORT_MODULE_PATH = ""
+    sys.modules["config"] = config
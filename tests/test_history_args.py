@@ -0,0 +1,44 @@
+from datetime import datetime
+
+import pytest
+
+from history_args import parse_history_args, encode_history_cursor, decode_history_cursor
+
+
+def test_cursor_round_trip():
+    at = datetime(2025, 1, 1, 12, 34, 56, 123456)
+    data = encode_history_cursor(at, 42)
+    assert data.startswith("hist:")
+    assert len(data.encode()) <= 64   # Telegram's callback_data limit
+    assert decode_history_cursor(data) == (at, 42)
+
+
+def test_cursor_without_microseconds():
+    at = datetime(2025, 1, 1, 0, 0)
+    assert decode_history_cursor(encode_history_cursor(at, 7)) == (at, 7)
+
+
+def test_parse_history_args_defaults():
+    assert parse_history_args("") == ("xlsx", None, None, None)
+    assert parse_history_args(None) == ("xlsx", None, None, None)
+
+
+def test_parse_history_args_full():
+    fmt, date_from, date_to, username = parse_history_args("2025-01-01 2025-03-31 @analyst CSV")
+    assert fmt == "csv"
+    assert username == "analyst"
+    assert date_from == datetime(2025, 1, 1)
+    # the end date is inclusive
+    assert date_to == datetime(2025, 4, 1)
+
+
+def test_parse_history_args_only_start():
+    _, date_from, date_to, _ = parse_history_args("2025-02-10")
+    assert date_from == datetime(2025, 2, 10)
+    assert date_to is None
+
+
+@pytest.mark.parametrize("args", ["2025-13-01", "yesterday", "2025-01-01 2025-01-02 2025-01-03"])
+def test_parse_history_args_invalid(args):
+    with pytest.raises(ValueError):
+        parse_history_args(args)
@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("aiogram")
+pytest.importorskip("psycopg2")
+
+import partner_picker  # noqa: E402
+from partner_picker import PartnerIndex  # noqa: E402
+
+
+PARTNERS = ["весь мир", "Германия", "Китай", "Корея, Республика", "Объединённые Арабские Эмираты", "Южная Корея"]
+
+
+def test_search_ranks_exact_prefix_word_and_substring():
+    index = PartnerIndex(PARTNERS)
+    assert index.search("китай") == [2]
+    # name prefixes come before word prefixes
+    assert index.search("Ко") == [3, 5]
+    assert index.search("юж") == [5]
+    assert index.search("арабские") == [4]
+    assert index.search("объединенные арабские эмираты") == [4]   # ё typed as е
+    assert index.search("ман") == [1]
+    assert index.search("   ") == []
+
+
+def test_search_falls_back_to_similar_names():
+    index = PartnerIndex(PARTNERS)
+    assert index.search("гремания") == [1]
+
+
+def test_buckets_skip_the_world():
+    index = PartnerIndex(PARTNERS)
+    assert index.letters == ["Г", "К", "О", "Ю"]
+    assert index.buckets["К"] == [2, 3]
+
+
+def test_version_identifies_the_list():
+    assert PartnerIndex(PARTNERS).version == PartnerIndex(list(PARTNERS)).version
+    assert PartnerIndex(PARTNERS).version != PartnerIndex(PARTNERS + ["Япония"]).version
+
+
+def test_index_is_rebuilt_when_the_list_changes(monkeypatch):
+    lists = [PARTNERS, PARTNERS, PARTNERS + ["Япония"]]
+
+    async def get_partners():
+        return lists.pop(0)
+
+    monkeypatch.setattr(partner_picker.ref_cache, "get_partners", get_partners)
+    monkeypatch.setattr(partner_picker, "_index", None)
+
+    async def main():
+        return [await partner_picker.get_partner_index() for _ in range(3)]
+
+    first, second, third = asyncio.run(main())
+    assert first is second
+    # buttons built from the old list now carry a stale version
+    assert third.version != first.version
+    assert third.partners[-1] == "Япония"
@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+
+from report_pool import ReportQueueFull
+from report_scheduler import PRIORITY_ADMIN, PRIORITY_BATCH, PRIORITY_USER, ReportScheduler, UserLimitReached
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+class Gate:
+    """Job functions that finish when released, recording the start order."""
+
+    def __init__(self):
+        self.started = []
+        self._events = {}
+
+    def job(self, name):
+        event = self._events[name] = asyncio.Event()
+
+        async def func():
+            self.started.append(name)
+            await event.wait()
+            return name
+        return func
+
+    def release(self, name):
+        self._events[name].set()
+
+
+def test_runs_by_priority_then_users_turn_then_arrival():
+    async def main():
+        scheduler = ReportScheduler(max_concurrency=1, per_user_limit=5, max_queue=10)
+        gate = Gate()
+        jobs = [scheduler.schedule("blocker", gate.job("blocker"))]
+        jobs.append(scheduler.schedule("a", gate.job("a1")))
+        jobs.append(scheduler.schedule("a", gate.job("a2")))
+        jobs.append(scheduler.schedule("b", gate.job("b1"), priority=PRIORITY_BATCH))
+        jobs.append(scheduler.schedule("c", gate.job("c1")))
+        jobs.append(scheduler.schedule("admin", gate.job("admin"), priority=PRIORITY_ADMIN))
+        for name in ["blocker", "admin", "a1", "c1", "a2", "b1"]:
+            await _settle()
+            gate.release(name)
+        await asyncio.gather(*(j.future for j in jobs))
+        return gate.started
+    assert run(main()) == ["blocker", "admin", "a1", "c1", "a2", "b1"]
+
+
+def test_per_user_limit_and_queue_bound():
+    async def main():
+        scheduler = ReportScheduler(max_concurrency=1, per_user_limit=2, max_queue=2)
+        gate = Gate()
+        scheduler.schedule("a", gate.job("a1"))   # running
+        scheduler.schedule("a", gate.job("a2"))   # queued
+        with pytest.raises(UserLimitReached):
+            scheduler.schedule("a", gate.job("a3"))
+        # a batch may ask for a higher limit of its own
+        scheduler.schedule("a", gate.job("a3"), user_limit=3)
+        with pytest.raises(ReportQueueFull):
+            scheduler.schedule("b", gate.job("b1"))
+        assert scheduler.stats() == {"running": 1, "queued": 2, "rejected": 2}
+        for name in ["a1", "a2", "a3"]:
+            await _settle()
+            gate.release(name)
+        await _settle()
+        # finished jobs no longer count against the user
+        scheduler.schedule("a", gate.job("a4"))
+        gate.release("a4")
+        await _settle()
+        return scheduler.stats()
+    assert run(main()) == {"running": 0, "queued": 0, "rejected": 2}
+
+
+def test_promote_moves_a_queued_job_up_and_reports_positions():
+    async def main():
+        scheduler = ReportScheduler(max_concurrency=1, per_user_limit=5, max_queue=10)
+        gate = Gate()
+        positions = {}
+
+        def progress(name):
+            async def on_progress(position):
+                positions.setdefault(name, []).append(position)
+            return on_progress
+
+        scheduler.schedule("x", gate.job("running"))
+        first = scheduler.schedule("a", gate.job("first"), on_progress=progress("first"))
+        late = scheduler.schedule("b", gate.job("late"), priority=PRIORITY_BATCH, on_progress=progress("late"))
+        scheduler.promote(late, PRIORITY_ADMIN)
+        scheduler.promote(first, PRIORITY_BATCH)   # never moves down
+        await _settle()
+        for name in ["running", "late", "first"]:
+            gate.release(name)
+            await _settle()
+        await asyncio.gather(first.future, late.future)
+        return gate.started, positions
+    started, positions = run(main())
+    assert started == ["running", "late", "first"]
+    assert positions["late"] == [2, 1, 0]
+    assert positions["first"] == [1, 2, 1, 0]
+
+
+def test_failure_reaches_the_caller_and_frees_the_slot():
+    async def main():
+        scheduler = ReportScheduler(max_concurrency=1, per_user_limit=1, max_queue=10)
+
+        async def boom():
+            raise RuntimeError("render failed")
+        with pytest.raises(RuntimeError):
+            await scheduler.run("a", boom)
+
+        async def ok():
+            return "done"
+        return await scheduler.run("a", ok, priority=PRIORITY_USER)
+    assert run(main()) == "done"
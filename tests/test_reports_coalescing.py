@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("aiogram")
+pytest.importorskip("psycopg2")
+
+import reports  # noqa: E402
+from report_scheduler import PRIORITY_ADMIN, PRIORITY_USER, ReportScheduler, UserLimitReached  # noqa: E402
+
+
+class FakeCache:
+    async def get(self, key, data_version):
+        return None
+
+    async def put(self, key, data_version, res):
+        pass
+
+    def stats(self):
+        return {}
+
+
+class FakePool:
+    in_flight = 0
+
+    def __init__(self, order):
+        self.order = order
+        self.calls = 0
+
+    async def submit(self, **kwargs):
+        self.calls += 1
+        self.order.append("report")
+        return {"status": "ok", "filename": "f.docx", "short_filename": "f.docx", "content": b"x"}
+
+
+@pytest.fixture
+def env(monkeypatch):
+    order = []
+    scheduler = ReportScheduler(max_concurrency=1, per_user_limit=1, max_queue=10)
+    pool = FakePool(order)
+
+    async def data_version():
+        return "v1"
+
+    monkeypatch.setattr(reports, "get_data_version", data_version)
+    monkeypatch.setattr(reports, "report_cache", FakeCache())
+    monkeypatch.setattr(reports, "report_scheduler", scheduler)
+    monkeypatch.setattr(reports, "report_pool", pool)
+    return scheduler, pool, order
+
+
+def _blocker(order, name):
+    release = asyncio.Event()
+
+    async def func():
+        await release.wait()
+        order.append(name)
+    return release, func
+
+
+def test_identical_requests_share_one_render_at_the_best_priority(env):
+    scheduler, pool, order = env
+    positions = {"a": [], "b": []}
+
+    def requester(name, priority):
+        async def on_progress(position):
+            positions[name].append(position)
+        return {"telegram_id": name, "priority": priority, "on_progress": on_progress}
+
+    async def main():
+        release, running = _blocker(order, "running")
+        scheduler.schedule("x", running)
+        _, queued = _blocker(order, "other")
+        other = scheduler.schedule("y", queued)
+        a = asyncio.ensure_future(reports.get_report(use_file_id=False, requester=requester("a", PRIORITY_USER), partner="p"))
+        await asyncio.sleep(0.01)
+        b = asyncio.ensure_future(reports.get_report(use_file_id=False, requester=requester("b", PRIORITY_ADMIN), partner="p"))
+        await asyncio.sleep(0.01)
+        release.set()
+        results = await asyncio.gather(a, b)
+        other.future.cancel()
+        return results
+
+    res_a, res_b = asyncio.run(main())
+    assert pool.calls == 1
+    assert res_a == res_b and res_a["status"] == "ok"
+    # the admin who joined moved the shared render ahead of the other job
+    assert order == ["running", "report"]
+    assert positions["a"][0] == 2 and positions["a"][-1] == 0
+    assert positions["b"][0] == 1 and positions["b"][-1] == 0
+
+
+def test_joiner_retries_when_the_starter_is_rejected(env):
+    scheduler, pool, order = env
+
+    scheduler.max_concurrency = 2
+
+    async def main():
+        release, busy = _blocker(order, "busy")
+        scheduler.schedule("a", busy)   # "a" is at their per-user limit
+        a = asyncio.ensure_future(reports.get_report(use_file_id=False, requester={"telegram_id": "a"}, partner="p"))
+        b = asyncio.ensure_future(reports.get_report(use_file_id=False, requester={"telegram_id": "b"}, partner="p"))
+        results = await asyncio.gather(a, b, return_exceptions=True)
+        release.set()
+        await asyncio.sleep(0)
+        return results
+
+    res_a, res_b = asyncio.run(main())
+    assert isinstance(res_a, UserLimitReached)
+    assert res_b["status"] == "ok"
+    assert pool.calls == 1
@@ -0,0 +1,30 @@
+from tnved_index import TnvedIndex
+
+
+CODES = ["8411", "841111", "841112", "8411110000", "8517", "851711", "8517110000", "8703"]
+
+
+def test_contains_and_len():
+    index = TnvedIndex(CODES + ["8411"])
+    assert len(index) == len(CODES)
+    assert "851711" in index
+    assert "9999" not in index
+
+
+def test_with_prefix_filters_by_digit_and_limit():
+    index = TnvedIndex(CODES)
+    assert index.with_prefix("8411", digit=6) == ["841111", "841112"]
+    assert index.with_prefix("8411", limit=2) == ["8411", "841111"]
+
+
+def test_suggest_known_code_lists_its_children():
+    index = TnvedIndex(CODES)
+    assert index.suggest("8411") == ["841111", "841112"]
+    assert index.suggest("8411110000") == ["8411110000"]
+
+
+def test_suggest_unknown_code_uses_longest_shared_prefix():
+    index = TnvedIndex(CODES)
+    assert index.suggest("841119") == ["841111", "841112"]
+    assert index.suggest("8519") == ["8517"]
+    assert index.suggest("12") == []
@@ -0,0 +1,24 @@
+import pytest
+
+pytest.importorskip("aiogram")
+
+from throttling import GENERATION, NAVIGATION, RateLimiter, TokenBucket  # noqa: E402
+
+
+def test_bucket_allows_a_burst_then_refills_at_rate():
+    bucket = TokenBucket(rate=2.0, burst=3)
+    now = bucket.updated
+    assert [bucket.take(now) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take(now) == pytest.approx(0.5)
+    assert bucket.take(now + 0.5) == 0.0
+    # refilling stops at the burst size
+    bucket.refill(now + 100)
+    assert bucket.tokens == 3
+
+
+def test_limiter_keeps_separate_buckets_per_user_and_kind():
+    limiter = RateLimiter({NAVIGATION: (1.0, 2), GENERATION: (0.1, 1)})
+    assert limiter.hit(1, GENERATION) == 0.0
+    assert limiter.hit(1, GENERATION) > 0
+    assert limiter.hit(1, NAVIGATION) == 0.0
+    assert limiter.hit(2, GENERATION) == 0.0
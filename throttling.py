@@ -0,0 +1,154 @@
+import time
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils.exceptions import TelegramAPIError
+
+import metrics
+from settings import (
+    THROTTLE_NAVIGATION_RATE,
+    THROTTLE_NAVIGATION_BURST,
+    THROTTLE_GENERATION_RATE,
+    THROTTLE_GENERATION_BURST,
+    THROTTLE_DUPLICATE_WINDOW,
+)
+
+
+NAVIGATION = "navigation"
+GENERATION = "generation"
+
+GENERATION_CALLBACKS = {"sn_confirm"}
+GENERATION_COMMANDS = {"batch"}
+
+SWEEP_INTERVAL = 60
+
+throttled_total = metrics.counter("bot_throttled_total", "Updates dropped by the rate limiter")
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        # callers may pass a ``now`` read just before the bucket was made
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def take(self, now):
+        """0 if a token was taken, else seconds until the next one."""
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """Token buckets per (user, command class).
+
+    Full buckets are dropped on a periodic sweep, so memory only holds
+    users who were active in the last few refill periods.
+    """
+
+    def __init__(self, limits):
+        self.limits = limits   # class -> (rate per second, burst)
+        self._buckets = {}
+        self._swept = time.monotonic()
+
+    def hit(self, user_id, kind):
+        now = time.monotonic()
+        if now - self._swept > SWEEP_INTERVAL:
+            self._sweep(now)
+        bucket = self._buckets.get((user_id, kind))
+        if bucket is None:
+            bucket = self._buckets[(user_id, kind)] = TokenBucket(*self.limits[kind])
+        return bucket.take(now)
+
+    def _sweep(self, now):
+        self._swept = now
+        for key, bucket in list(self._buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self._buckets[key]
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Drops updates of users who exceed their rate, before any handler,
+    FSM or DB work runs, and swallows repeated taps on the same
+    confirmation button.
+
+    Limits are per process; in webhook mode all updates of a chat go to
+    the same worker, so a user's buckets still live in one place.
+    """
+
+    def __init__(self, limiter=None, duplicate_window=THROTTLE_DUPLICATE_WINDOW):
+        super().__init__()
+        self.limiter = limiter or RateLimiter({
+            NAVIGATION: (THROTTLE_NAVIGATION_RATE, THROTTLE_NAVIGATION_BURST),
+            GENERATION: (THROTTLE_GENERATION_RATE, THROTTLE_GENERATION_BURST),
+        })
+        self.duplicate_window = duplicate_window
+        self._pressed = {}   # (chat id, message id, data) -> monotonic time
+        self._warned = {}    # user id -> monotonic time of the last throttling reply
+
+    def _is_duplicate(self, cbq):
+        now = time.monotonic()
+        if len(self._pressed) > 1000:
+            self._pressed = {k: t for k, t in self._pressed.items() if now - t < self.duplicate_window}
+        key = (cbq.message.chat.id, cbq.message.message_id, cbq.data)
+        pressed = self._pressed.get(key)
+        self._pressed[key] = now
+        return pressed is not None and now - pressed < self.duplicate_window
+
+    def _should_warn(self, user_id, retry_after):
+        # one throttling reply per wait period, not one per dropped update
+        now = time.monotonic()
+        if now < self._warned.get(user_id, 0):
+            return False
+        if len(self._warned) > 1000:
+            self._warned = {k: t for k, t in self._warned.items() if t > now}
+        self._warned[user_id] = now + retry_after
+        return True
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        kind = GENERATION if message.get_command(pure=True) in GENERATION_COMMANDS else NAVIGATION
+        retry_after = self.limiter.hit(message.from_user.id, kind)
+        if not retry_after:
+            return
+        throttled_total.inc(kind=kind)
+        if self._should_warn(message.from_user.id, retry_after):
+            await message.answer(_throttled_text(kind, retry_after))
+        raise CancelHandler()
+
+    async def on_pre_process_callback_query(self, cbq: types.CallbackQuery, data: dict):
+        kind = GENERATION if cbq.data in GENERATION_CALLBACKS else NAVIGATION
+        if kind == GENERATION and cbq.message is not None and self._is_duplicate(cbq):
+            throttled_total.inc(kind="duplicate")
+            await _answer(cbq, "Запрос уже принят, справка готовится.")
+            raise CancelHandler()
+
+        retry_after = self.limiter.hit(cbq.from_user.id, kind)
+        if not retry_after:
+            return
+        throttled_total.inc(kind=kind)
+        await _answer(cbq, _throttled_text(kind, retry_after))
+        raise CancelHandler()
+
+
+def _throttled_text(kind, retry_after):
+    seconds = max(1, round(retry_after))
+    if kind == GENERATION:
+        return f"Вы заказываете справки слишком часто. Следующую можно будет заказать через {seconds} с."
+    return f"Слишком много запросов. Пожалуйста, подождите {seconds} с."
+
+
+async def _answer(cbq, text):
+    try:
+        await cbq.answer(text)
+    except TelegramAPIError:
+        pass
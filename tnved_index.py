@@ -0,0 +1,47 @@
+from bisect import bisect_left
+
+
+NEXT_DIGIT = {4: 6, 6: 10}
+
+
+class TnvedIndex:
+    def __init__(self, codes):
+        # the sorted tuple and the set share the same str objects,
+        # so the second structure costs only pointers
+        self._sorted = tuple(sorted(set(codes)))
+        self._set = frozenset(self._sorted)
+
+    def __contains__(self, code):
+        return code in self._set
+
+    def __len__(self):
+        return len(self._sorted)
+
+    def with_prefix(self, prefix, limit=10, digit=None):
+        found = []
+        i = bisect_left(self._sorted, prefix)
+        while i < len(self._sorted) and self._sorted[i].startswith(prefix):
+            code = self._sorted[i]
+            if digit is None or len(code) == digit:
+                found.append(code)
+                if len(found) >= limit:
+                    break
+            i += 1
+        return found
+
+    def children(self, code, limit=10):
+        digit = NEXT_DIGIT.get(len(code))
+        if digit is None:
+            return []
+        return self.with_prefix(code, limit=limit, digit=digit)
+
+    def suggest(self, text, limit=10):
+        """Codes sharing the longest possible prefix with ``text``."""
+        if text in self._set:
+            return self.children(text, limit) or [text]
+        for n in range(min(len(text), 10), 1, -1):
+            digit = min(d for d in (4, 6, 10) if d >= n)
+            found = self.with_prefix(text[:n], limit=limit, digit=digit)
+            if found:
+                return found
+        return []
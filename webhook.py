@@ -0,0 +1,204 @@
+"""Webhook deployment: one aiohttp front process, N update-processing workers.
+
+The front process only checks the secret token and routes the raw update
+to a worker chosen by chat id, so all updates of one chat are handled by
+the same worker, one after another, while different chats run in
+parallel across workers and within each worker. Only dispatch is
+ordered: report renders run detached from their update.
+"""
+import asyncio
+import json
+import multiprocessing
+import queue
+import sys
+
+from aiohttp import web
+
+from settings import (
+    DB_EXECUTOR_WORKERS,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_URL,
+    WEBHOOK_SECRET,
+    WEBHOOK_WORKERS,
+    WEBHOOK_QUEUE_SIZE,
+)
+
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def update_chat_id(update):
+    for kind in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if kind in update:
+            return update[kind]["chat"]["id"]
+    if "callback_query" in update:
+        cbq = update["callback_query"]
+        if "message" in cbq:
+            return cbq["message"]["chat"]["id"]
+        return cbq["from"]["id"]
+    for kind in ("inline_query", "chosen_inline_result", "my_chat_member", "chat_member", "chat_join_request"):
+        if kind in update:
+            obj = update[kind]
+            return obj["chat"]["id"] if "chat" in obj else obj["from"]["id"]
+    return update.get("update_id", 0)
+
+
+def _share_limits(workers):
+    # Every worker has its own DB pools and executor, report pool,
+    # scheduler and job consumers; each gets its share so all of them
+    # together stay within the limits configured for one bot.
+    from concurrent.futures import ThreadPoolExecutor
+
+    import bot_db
+    import bot_db_async
+    import report_jobs
+    from report_pool import report_pool
+    from report_scheduler import report_scheduler
+
+    def share(n):
+        return max(1, n // workers)
+
+    for pool in (bot_db.trade_pool, bot_db.users_pool):
+        pool.max_size = share(pool.max_size)
+        pool.min_size = min(pool.min_size, pool.max_size)
+    # nothing has run on it yet, so it can simply be replaced
+    bot_db_async._executor.shutdown()
+    bot_db_async._executor = ThreadPoolExecutor(
+        max_workers=share(DB_EXECUTOR_WORKERS), thread_name_prefix="bot_db")
+    report_pool.workers = share(report_pool.workers)
+    report_pool.queue_size = share(report_pool.queue_size)
+    report_scheduler.max_concurrency = share(report_scheduler.max_concurrency)
+    report_scheduler.max_queue = share(report_scheduler.max_queue)
+    report_jobs.REPORT_JOB_CONSUMERS = share(report_jobs.REPORT_JOB_CONSUMERS)
+
+
+async def _worker_loop(updates, number, workers):
+    from aiogram import Bot, Dispatcher, types
+    import metrics
+
+    _share_limits(workers)
+    import bot
+
+    metrics.port_offset = number
+
+    dp = bot.dp
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+    await bot.on_startup(dp)
+
+    loop = asyncio.get_running_loop()
+    chat_locks = {}   # chat_id -> [lock, users]
+    tasks = set()
+
+    async def process(chat_id, update):
+        entry = chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await dp.process_update(types.Update(**update))
+        except Exception as e:
+            print(f"Update {update.get('update_id')} failed: {e}")
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                chat_locks.pop(chat_id, None)
+
+    try:
+        while True:
+            item = await loop.run_in_executor(None, updates.get)
+            if item is None:
+                break
+            chat_id, raw = item
+            task = asyncio.create_task(process(chat_id, json.loads(raw)))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        await bot.on_shutdown(dp)
+        await dp.bot.session.close()
+
+
+def _worker_main(updates, number, workers):
+    asyncio.run(_worker_loop(updates, number, workers))
+
+
+class WebhookFront:
+    def __init__(self, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE):
+        ctx = multiprocessing.get_context("spawn")
+        self.queues = [ctx.Queue(maxsize=queue_size) for _ in range(workers)]
+        # not daemonic: a worker starts the report ProcessPoolExecutor, and
+        # daemonic processes may not have children. on_shutdown stops them.
+        self.processes = [
+            ctx.Process(target=_worker_main, args=(q, n, workers), name=f"bot-worker-{n}")
+            for n, q in enumerate(self.queues)
+        ]
+
+    async def handle(self, request):
+        if WEBHOOK_SECRET and request.headers.get(SECRET_HEADER) != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        raw = await request.text()
+        try:
+            chat_id = update_chat_id(json.loads(raw))
+        except (ValueError, KeyError, TypeError):
+            return web.Response(status=400)
+        try:
+            self.queues[hash(chat_id) % len(self.queues)].put_nowait((chat_id, raw))
+        except queue.Full:
+            # Telegram re-delivers the update later
+            return web.Response(status=503)
+        return web.Response()
+
+    async def on_startup(self, app):
+        from aiogram import Bot
+        from config import API_TOKEN
+
+        # spawn re-runs the parent's __main__ in every worker; with bot.py
+        # as __main__ that would build a second dispatcher there. This
+        # module has no import-time side effects, so it stands in for it.
+        main = sys.modules["__main__"]
+        sys.modules["__main__"] = sys.modules[__name__]
+        try:
+            for p in self.processes:
+                p.start()
+        finally:
+            sys.modules["__main__"] = main
+        bot = Bot(token=API_TOKEN)
+        try:
+            await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+        except Exception:
+            # non-daemonic workers would otherwise keep the process alive
+            await self.stop_workers()
+            raise
+        finally:
+            await bot.session.close()
+
+    async def stop_workers(self):
+        loop = asyncio.get_running_loop()
+        for q, p in zip(self.queues, self.processes):
+            if p.is_alive():
+                await loop.run_in_executor(None, q.put, None)
+        for p in self.processes:
+            await loop.run_in_executor(None, p.join)
+
+    async def on_shutdown(self, app):
+        await self.stop_workers()
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.handle)
+        app.on_startup.append(self.on_startup)
+        app.on_shutdown.append(self.on_shutdown)
+        return app
+
+
+def main():
+    if not WEBHOOK_URL:
+        raise SystemExit("WEBHOOK_URL is not set in config.py")
+    web.run_app(WebhookFront().make_app(), host=WEBHOOK_HOST, port=WEBHOOK_PORT)
+
+
+if __name__ == '__main__':
+    main()